@@ -0,0 +1,315 @@
+# Copyright 2015 Altova GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+__copyright__ = 'Copyright 2015 Altova GmbH'
+__license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
+
+# This module provides an asyncio based HTTP download engine used to fetch filings from the SEC archive.
+#
+# Files are downloaded over persistent keep-alive connections (HTTP/1.1) and streamed to disk in chunks.
+# All requests pass through a token bucket limiter so that SEC's fair access policy (max. 10 requests/second) is respected.
+# Failed requests are retried with exponential backoff and jitter.
+
+import asyncio,ssl,random,time,os.path,logging,urllib.parse
+from url_utils import user_agent
+
+# create logger
+logger = logging.getLogger('default')
+
+# SEC's fair access policy allows at most 10 requests per second
+sec_max_requests_per_second = 10
+
+chunk_size = 64*1024
+
+class DownloadError(Exception):
+    """Raised when a file cannot be downloaded."""
+
+    def __init__(self, url, message, retry=True):
+        super().__init__('%s: %s'%(url,message))
+        self.retry = retry
+
+class TokenBucket:
+    """Limits the rate of requests to the given number per second (allowing bursts up to capacity)."""
+
+    def __init__(self, rate, capacity=None):
+        self._rate = rate
+        self._capacity = capacity if capacity is not None else rate
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Waits until a token is available and consumes it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now-self._last)*self._rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1-self._tokens)/self._rate)
+
+class ConnectionPool:
+    """Keeps idle keep-alive connections per (scheme, host, port) for reuse."""
+
+    def __init__(self, ssl_context):
+        self._ssl_context = ssl_context
+        self._idle = {}
+
+    async def acquire(self, scheme, host, port):
+        """Returns a tuple (reader, writer, reused) with an idle or a newly opened connection."""
+        idle = self._idle.get((scheme,host,port))
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.open_connection(host, port, ssl=self._ssl_context if scheme == 'https' else None, limit=chunk_size)
+        return reader, writer, False
+
+    def release(self, scheme, host, port, reader, writer):
+        """Returns a connection that can be reused to the pool."""
+        self._idle.setdefault((scheme,host,port),[]).append((reader,writer))
+
+    def close(self):
+        """Closes all idle connections."""
+        for connections in self._idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+class Downloader:
+    """Downloads files concurrently over pooled connections with rate limiting and retries."""
+
+    def __init__(self, max_connections=8, rate=sec_max_requests_per_second, max_retries=3, backoff_base=1.0, backoff_max=60.0, timeout=300, verify=None, quarantine=None, on_complete=None):
+        """verify is an optional function that is called with the path of each completely downloaded file and returns None if the file is intact or a str describing the problem.
+        quarantine is an optional function that is called with the path of a corrupt download to move it out of the way (otherwise it is deleted).
+        on_complete is an optional function that is called with (url, filepath, attempts, error) after each download has finished (error is None on success).
+        It is run in a thread of the default executor so that blocking work like checksumming the file or writing to a DB does not stall the event loop."""
+        self.max_connections = max_connections
+        self.rate = rate
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.verify = verify
+        self.quarantine = quarantine
+        self.on_complete = on_complete
+        self.files = 0
+        self.failed = 0
+        self.bytes = 0
+        self.elapsed = 0
+
+    def backoff(self, attempt):
+        """Returns the delay in seconds before the given retry attempt (exponential backoff with full jitter)."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    async def _request(self, pool, url, headers=None):
+        """Sends a GET request and returns a tuple (status, response headers, reader, writer, reusable, connection key)."""
+        parts = urllib.parse.urlsplit(url)
+        scheme, host = parts.scheme, parts.hostname
+        port = parts.port or (443 if scheme == 'https' else 80)
+        path = parts.path + ('?'+parts.query if parts.query else '')
+        request = 'GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: %s\r\nAccept-Encoding: identity\r\nConnection: keep-alive\r\n' % (path or '/', parts.netloc, user_agent)
+        for name, value in (headers or {}).items():
+            request += '%s: %s\r\n' % (name, value)
+        request += '\r\n'
+
+        while True:
+            reader, writer, reused = await pool.acquire(scheme, host, port)
+            try:
+                writer.write(request.encode('ascii'))
+                await writer.drain()
+                status_line = await reader.readline()
+            except (ConnectionError, OSError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            if not status_line:
+                # The server closed an idle keep-alive connection, retry with a new connection
+                writer.close()
+                if reused:
+                    continue
+                raise DownloadError(url, 'Connection closed by server')
+            break
+
+        version, status = status_line.decode('latin-1').split(None,2)[:2]
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        reusable = version == 'HTTP/1.1' and response_headers.get('connection','').lower() != 'close'
+        return int(status), response_headers, reader, writer, reusable, (scheme, host, port)
+
+    async def _read_body(self, reader, response_headers, sink):
+        """Streams the response body in chunks to the given sink function and returns the number of bytes read and whether the connection can be reused."""
+        size = 0
+        if 'chunked' in response_headers.get('transfer-encoding','').lower():
+            while True:
+                chunk_length = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if chunk_length == 0:
+                    # Skip any trailer headers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return size, True
+                remaining = chunk_length
+                while remaining:
+                    data = await reader.read(min(remaining, chunk_size))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b'', remaining)
+                    sink(data)
+                    size += len(data)
+                    remaining -= len(data)
+                await reader.readline()
+        elif 'content-length' in response_headers:
+            remaining = int(response_headers['content-length'])
+            while remaining:
+                data = await reader.read(min(remaining, chunk_size))
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                sink(data)
+                size += len(data)
+                remaining -= len(data)
+            return size, True
+        else:
+            while True:
+                data = await reader.read(chunk_size)
+                if not data:
+                    return size, False
+                sink(data)
+                size += len(data)
+
+    async def fetch(self, pool, url, partpath, max_redirects=5):
+        """Downloads url to partpath (streaming the response in chunks to disk). If partpath already contains the beginning of the file, the download is resumed with a HTTP range request. Returns the number of bytes transferred."""
+        offset = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset else None
+        for redirect in range(max_redirects+1):
+            status, response_headers, reader, writer, reusable, key = await self._request(pool, url, headers)
+            try:
+                if status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+                    await self._read_body(reader, response_headers, lambda data: None)
+                    url = urllib.parse.urljoin(url, response_headers['location'])
+                    continue
+                if status == 416 and offset:
+                    # The partial file is already complete (e.g. the rename was interrupted), let the verification decide
+                    await self._read_body(reader, response_headers, lambda data: None)
+                    return 0
+                if status == 206 and not response_headers.get('content-range','').startswith('bytes %d-' % offset):
+                    # The unread body would be taken as the next response, so the connection cannot be reused
+                    reusable = False
+                    os.remove(partpath)
+                    raise DownloadError(url, 'Unexpected content range %s' % response_headers.get('content-range'))
+                if status not in (200, 206):
+                    await self._read_body(reader, response_headers, lambda data: None)
+                    raise DownloadError(url, 'HTTP status %d' % status, retry=status == 429 or status >= 500)
+                if status == 206:
+                    logger.info('Resuming download of %s at byte %d', url, offset)
+                with open(partpath, 'ab' if status == 206 else 'wb') as f:
+                    size, complete = await self._read_body(reader, response_headers, f.write)
+                reusable = reusable and complete
+                return size
+            except BaseException as e:
+                # The response body has been consumed completely only for errors raised on purpose
+                if not isinstance(e, DownloadError):
+                    reusable = False
+                raise
+            finally:
+                if reusable:
+                    pool.release(*key, reader, writer)
+                else:
+                    writer.close()
+        raise DownloadError(url, 'Too many redirects', retry=False)
+
+    async def _download(self, pool, limiter, url, filepath):
+        """Downloads a single file with retries. Returns True if the download succeeded.
+
+        The file is written to a temporary .part file which is verified and then atomically renamed to filepath.
+        An interrupted download keeps the .part file so that the next attempt (or run) can resume it."""
+        partpath = filepath + '.part'
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            try:
+                logger.info('Downloading filing %s', url)
+                size = await asyncio.wait_for(self.fetch(pool, url, partpath), self.timeout)
+                # Checking the CRCs reads the whole file, which must not stall the event loop
+                error = await asyncio.get_running_loop().run_in_executor(None, self.verify, partpath) if self.verify else None
+                if error:
+                    if self.quarantine:
+                        self.quarantine(partpath)
+                    elif os.path.exists(partpath):
+                        os.remove(partpath)
+                    raise DownloadError(url, 'Corrupt download (%s)' % error)
+                os.replace(partpath, filepath)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, DownloadError) as e:
+                retry = getattr(e, 'retry', True)
+                if not retry or attempt >= self.max_retries:
+                    logger.error('Failed downloading filing %s: %s', url, e)
+                    self.failed += 1
+                    if self.on_complete:
+                        await asyncio.get_running_loop().run_in_executor(None, self.on_complete, url, filepath, attempt+1, str(e))
+                    return False
+                delay = self.backoff(attempt)
+                attempt += 1
+                logger.info('Retry downloading filing %s in %.1fs (%s)', url, delay, e)
+                await asyncio.sleep(delay)
+            else:
+                logger.info('Succeeded downloading filing %s', url)
+                self.files += 1
+                self.bytes += size
+                if self.on_complete:
+                    await asyncio.get_running_loop().run_in_executor(None, self.on_complete, url, filepath, attempt+1, None)
+                return True
+
+    async def download_async(self, jobs, priority=None):
+        """Downloads all (url, filepath) jobs using max_connections concurrent workers. If given, priority is a function returning a sort key for (url, filepath), jobs with the lowest key are downloaded first."""
+        queue = asyncio.PriorityQueue()
+        for seq, (url, filepath) in enumerate(jobs):
+            queue.put_nowait((priority(url, filepath) if priority else (), seq, url, filepath))
+
+        pool = ConnectionPool(ssl.SSLContext())
+        limiter = TokenBucket(self.rate)
+
+        async def worker():
+            while True:
+                try:
+                    _, _, url, filepath = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await self._download(pool, limiter, url, filepath)
+
+        try:
+            await asyncio.gather(*(worker() for i in range(self.max_connections)))
+        finally:
+            pool.close()
+
+    def download(self, jobs, priority=None):
+        """Downloads all (url, filepath) jobs (in the order given by the priority function) and logs the achieved throughput."""
+        jobs = list(jobs)
+        if not jobs:
+            return
+        start = time.perf_counter()
+        files, failed, size = self.files, self.failed, self.bytes
+        asyncio.run(self.download_async(jobs, priority))
+        elapsed = time.perf_counter()-start
+        self.elapsed += elapsed
+        self.log_throughput(self.files-files, self.failed-failed, self.bytes-size, elapsed)
+
+    def log_throughput(self, files, failed, size, elapsed):
+        """Logs the number of downloaded files and the throughput in files/s and MB/s."""
+        logger.info('Downloaded %d files (%.1f MB, %d failed) in %.1fs: %.2f files/s, %.2f MB/s', files, size/1e6, failed, elapsed, files/elapsed if elapsed else 0, size/1e6/elapsed if elapsed else 0)
@@ -0,0 +1,169 @@
+# Copyright 2015 Altova GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+__copyright__ = 'Copyright 2015 Altova GmbH'
+__license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
+
+# Runs the asyncio download engine against a local stand-in for the SEC archive and reports the achieved throughput.
+#
+# The stand-in HTTP server keeps connections alive, supports range requests and injects faults:
+# some files first answer with HTTP 503 (exercising the backoff) and some close the connection in the middle of the body (exercising the resume with a range request).
+# The downloaded files are compared with the served content.
+#
+# Usage:
+#   python scripts/benchmark_downloads.py --files 200 --size 100000
+
+import async_download
+import os,sys,re,random,hashlib,shutil,tempfile,threading,logging,argparse,http.server
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """Serves files/<n>.zip with deterministic random content and counts connections, requests and injected faults."""
+
+    daemon_threads = True
+
+    def __init__(self, files, size, fail_every, truncate_every):
+        super().__init__(('127.0.0.1',0), StandInHandler)
+        self.size = size
+        self.fail_every = fail_every
+        self.truncate_every = truncate_every
+        self.contents = [random.Random(n).randbytes(size) for n in range(files)]
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.counts = dict(connections=0, requests=0, failed=0, truncated=0, ranges=0)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def first_request(self, n):
+        """Returns True for the first request of file n."""
+        with self.lock:
+            if n in self.seen:
+                return False
+            self.seen.add(n)
+            return True
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Handles GET requests over HTTP/1.1 keep-alive connections."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.count('requests')
+        match = re.fullmatch(r'/files/(\d+)\.zip', self.path)
+        if not match or int(match.group(1)) >= len(self.server.contents):
+            self.send_error(404)
+            return
+        n = int(match.group(1))
+        content = self.server.contents[n]
+        first = self.server.first_request(n)
+
+        if first and self.server.fail_every and n % self.server.fail_every == 0:
+            self.server.count('failed')
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        offset = 0
+        range_header = self.headers.get('Range')
+        if range_header:
+            offset = int(re.fullmatch(r'bytes=(\d+)-', range_header).group(1))
+            if offset >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.server.count('ranges')
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (offset, len(content)-1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(content)-offset))
+        self.end_headers()
+
+        if first and self.server.truncate_every and n % self.server.truncate_every == 1 % self.server.truncate_every:
+            # Drop the connection in the middle of the body
+            self.server.count('truncated')
+            self.wfile.write(content[offset:offset+(len(content)-offset)//2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(content[offset:])
+
+def run_benchmark(server, dir, args):
+    """Downloads all files of the stand-in server into dir and returns the Downloader and the list of files with wrong content."""
+    host, port = server.server_address
+    jobs = [('http://%s:%d/files/%d.zip' % (host, port, n), os.path.join(dir, '%d.zip' % n)) for n in range(args.files)]
+    downloader = async_download.Downloader(max_connections=args.max_threads, rate=args.rate, max_retries=args.retries, backoff_base=args.backoff)
+    downloader.download(jobs)
+
+    wrong = []
+    for (url, filepath), content in zip(jobs, server.contents):
+        if not os.path.exists(filepath):
+            wrong.append(filepath)
+            continue
+        with open(filepath, 'rb') as f:
+            if hashlib.sha256(f.read()).digest() != hashlib.sha256(content).digest():
+                wrong.append(filepath)
+    return downloader, wrong
+
+def parse_args():
+    """Returns the arguments and options passed to the script."""
+    parser = argparse.ArgumentParser(description='Runs the asyncio download engine against a local stand-in HTTP server and reports the achieved throughput.')
+    parser.add_argument('--files', type=int, default=100, help='number of files to download')
+    parser.add_argument('--size', type=int, default=100000, help='size of each file in bytes')
+    parser.add_argument('--threads', type=int, default=8, dest='max_threads', help='number of concurrent connections')
+    parser.add_argument('--rate-limit', type=float, default=async_download.sec_max_requests_per_second, dest='rate', help='max. number of requests per second')
+    parser.add_argument('--retries', type=int, default=3, help='number of retries per file')
+    parser.add_argument('--backoff', type=float, default=0.1, help='base delay in seconds of the exponential backoff')
+    parser.add_argument('--fail-every', type=int, default=10, help='answer the first request of every n-th file with HTTP 503 (0 to disable)')
+    parser.add_argument('--truncate-every', type=int, default=10, help='drop the connection during the first response of every n-th file (0 to disable)')
+    parser.add_argument('--log-level', metavar='LOG_LEVEL', dest='log_level', choices=['ERROR', 'WARNING', 'INFO', 'DEBUG'], default='WARNING', help='log level (ERROR|WARNING|INFO|DEBUG)')
+    return parser.parse_args()
+
+def main():
+    # Parse script arguments
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',level=getattr(logging,args.log_level))
+
+    server = StandInServer(args.files, args.size, args.fail_every, args.truncate_every)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    dir = tempfile.mkdtemp()
+    try:
+        downloader, wrong = run_benchmark(server, dir, args)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(dir)
+
+    counts = server.counts
+    print('Downloaded %d files (%.1f MB, %d failed) in %.1fs: %.2f files/s, %.2f MB/s' % (downloader.files, downloader.bytes/1e6, downloader.failed, downloader.elapsed, downloader.files/downloader.elapsed if downloader.elapsed else 0, downloader.bytes/1e6/downloader.elapsed if downloader.elapsed else 0))
+    print('%d requests over %d connections, %d answered with HTTP 503, %d truncated, %d resumed with a range request' % (counts['requests'], counts['connections'], counts['failed'], counts['truncated'], counts['ranges']))
+    if wrong:
+        print('%d files have wrong content: %s' % (len(wrong), ', '.join(os.path.basename(filepath) for filepath in wrong)))
+        sys.exit(1)
+    if counts['ranges'] < counts['truncated']:
+        print('Not all truncated downloads were resumed')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
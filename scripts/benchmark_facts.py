@@ -0,0 +1,106 @@
+# Copyright 2015 Altova GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+__copyright__ = 'Copyright 2015 Altova GmbH'
+__license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
+
+# Measures the time needed to look up the values of all monetary concepts in the financial statements of SEC filings
+# by filtering the facts of the instance (as done before) and with the fact index used by build_secdb.py.
+#
+# Usage:
+#   raptorxmlxbrl script scripts/benchmark_facts.py feeds/xbrlrss-2015-04.xml --cik=320193
+
+import feed_tools, build_secdb
+import time,logging,argparse
+
+def filter_monetary_value(instance, concept, context, currency):
+    """Returns the fact value found for the given concept, context and currency by filtering all facts of the instance."""
+    for fact in instance.facts.filter(concept, context):
+        if fact.xsi_nil:
+            continue
+        if fact.unit_aspect_value.iso4217_currency == currency:
+            return int(fact.effective_numeric_value)
+    return None
+
+def statement_lookups(instance):
+    """Returns a list of (concept, context) pairs looked up when calculating the financial statements of the instance."""
+    lookups = []
+    linkroles = build_secdb.classify_presentation_link_roles(instance.dts)
+    usgaap_ns, dei_ns = build_secdb.find_std_namespaces(instance.dts)
+    required_context = build_secdb.find_required_context(instance,dei_ns)
+    if not required_context or not required_context.period.is_start_end():
+        return lookups
+    required_instant_context = build_secdb.find_required_instant_context(instance,required_context.period.end_date.value)
+
+    for kind, context in (('balance',required_instant_context),('income',required_context),('cashflow',required_context)):
+        if not context or not linkroles[kind]:
+            continue
+        concepts, dimensions = build_secdb.presentation_concepts(instance.dts,linkroles[kind][0])
+        contexts = [context]
+        if dimensions:
+            contexts.extend(build_secdb.find_dimension_contexts(instance,context,dimensions))
+        for concept, preferred_label_role, level in concepts:
+            if not concept.abstract and concept.is_monetary():
+                lookups.extend((concept,dim_context) for dim_context in contexts)
+    return lookups
+
+def benchmark_filing(filing):
+    """Returns a tuple with the number of lookups and the time needed without and with the fact index (including building the index)."""
+    instance, log = feed_tools.load_instance(filing)
+    if not instance:
+        return None
+    lookups = statement_lookups(instance)
+
+    start = time.perf_counter()
+    expected = [filter_monetary_value(instance,concept,context,'USD') for concept, context in lookups]
+    filtered = time.perf_counter()-start
+
+    start = time.perf_counter()
+    index = build_secdb.FactIndex(instance)
+    actual = [index.monetary_value(concept,context,'USD') for concept, context in lookups]
+    indexed = time.perf_counter()-start
+
+    if actual != expected:
+        logging.getLogger('default').error('Fact index returned different values for filing %s',filing['accessionNumber'])
+    return len(lookups), filtered, indexed
+
+def parse_args():
+    """Returns the arguments and options passed to the script."""
+    parser = argparse.ArgumentParser(description='Measures the time needed to look up fact values with and without the fact index.')
+    parser.add_argument('rss_feed', metavar='RSS', help='EDGAR RSS feed file')
+    parser.add_argument('--cik', type=int, help='CIK number')
+    parser.add_argument('--limit', type=int, default=10, help='maximum number of filings to process')
+    return parser.parse_args()
+
+def main():
+    # Parse script arguments
+    args = parse_args()
+    build_secdb.setup_logging(None)
+
+    tickers = feed_tools.load_ticker_symbols()
+    filings = [filing for filing in feed_tools.read_feed(args.rss_feed) if feed_tools.is_secdb_filing(filing,tickers,args.cik)][:args.limit]
+
+    total_filtered, total_indexed = 0, 0
+    print('%-22s %8s %12s %12s %8s'%('filing','lookups','filter [s]','index [s]','speedup'))
+    for filing in filings:
+        result = benchmark_filing(filing)
+        if not result:
+            continue
+        count, filtered, indexed = result
+        total_filtered += filtered
+        total_indexed += indexed
+        print('%-22s %8d %12.3f %12.3f %7.1fx'%(filing['accessionNumber'],count,filtered,indexed,filtered/indexed if indexed else 0))
+    print('%-22s %8s %12.3f %12.3f %7.1fx'%('total','',total_filtered,total_indexed,total_filtered/total_indexed if total_indexed else 0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Copyright 2015 Altova GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+__copyright__ = 'Copyright 2015 Altova GmbH'
+__license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
+
+# Measures the time needed to read EDGAR RSS feeds without (cold) and with (warm) the parsed feed cache.
+#
+# Usage:
+#   raptorxmlxbrl script scripts/benchmark_feeds.py feeds/xbrlrss-2015-*.xml
+
+import feed_tools
+import os.path,glob,time,logging,argparse
+
+def benchmark_feed(feedpath):
+    """Returns a tuple with the number of filings and the cold and warm read times of the RSS feed."""
+    cachepath = feed_tools.feed_cache_path(feedpath)
+    if os.path.exists(cachepath):
+        os.remove(cachepath)
+
+    start = time.perf_counter()
+    filings = feed_tools.read_feed(feedpath)
+    cold = time.perf_counter()-start
+
+    start = time.perf_counter()
+    feed_tools.read_feed(feedpath)
+    warm = time.perf_counter()-start
+
+    return len(filings), cold, warm
+
+def collect_feeds(args):
+    """Returns an generator of the resolved, absolute RSS file paths."""
+    for arg in args:
+        for feedpath in glob.iglob(os.path.abspath(arg)):
+            yield feedpath
+
+def parse_args():
+    """Returns the arguments and options passed to the script."""
+    parser = argparse.ArgumentParser(description='Measures the time needed to read EDGAR RSS feeds without and with the parsed feed cache.')
+    parser.add_argument('rss_feeds', metavar='RSS', nargs='+', help='EDGAR RSS feed file')
+    return parser.parse_args()
+
+def main():
+    # Parse script arguments
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',level=logging.WARNING)
+
+    total_cold, total_warm = 0, 0
+    print('%-24s %8s %10s %10s %8s'%('feed','filings','cold [s]','warm [s]','speedup'))
+    for feedpath in collect_feeds(args.rss_feeds):
+        count, cold, warm = benchmark_feed(feedpath)
+        total_cold += cold
+        total_warm += warm
+        print('%-24s %8d %10.3f %10.3f %7.1fx'%(os.path.basename(feedpath),count,cold,warm,cold/warm if warm else 0))
+    print('%-24s %8s %10.3f %10.3f %7.1fx'%('total','',total_cold,total_warm,total_cold/total_warm if total_warm else 0))
+
+if __name__ == '__main__':
+    main()
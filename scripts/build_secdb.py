@@ -19,37 +19,442 @@ __license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
 # Usage:
 #   raptorxmlxbrl script scripts/build_secdb.py feeds/xbrlrss-2015-*.xml --db=sec2015.db3
 
-import feed_tools
-import re,csv,json,glob,enum,datetime,argparse,logging,itertools,os.path,urllib,threading,concurrent.futures,timeit,calendar
+import feed_tools, filings_index, download_manifest, download_filings, concept_mappings, bulk_ratios
+import re,csv,json,glob,enum,datetime,argparse,logging,itertools,os.path,urllib,threading,queue,concurrent.futures,timeit,time,calendar,tempfile
 from altova_api.v2 import xml, xsd, xbrl
 
-class Summations(dict):
-    def __missing__(self, key):
-        return 0
+class LineItems:
+    """Fixed-size vector of the line item values of a report in the order of the line items in reports.json. Missing values are None."""
+    __slots__ = ('slots','values')
+
+    def __init__(self, report, values=None):
+        self.slots = report['slots']
+        self.values = list(values) if values is not None else [None]*len(self.slots)
+
+    @classmethod
+    def zeros(cls, report):
+        """Returns a vector with all line item values set to 0."""
+        return cls(report,[0]*len(report['slots']))
+
+    def __getitem__(self, lineitem):
+        return self.values[self.slots[lineitem]]
+
+    def __setitem__(self, lineitem, value):
+        self.values[self.slots[lineitem]] = value
+
+    def __contains__(self, lineitem):
+        return self.values[self.slots[lineitem]] is not None
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, lineitem, value):
+        """Adds the value to the given line item (a missing line item value is treated as 0)."""
+        slot = self.slots[lineitem]
+        current = self.values[slot]
+        self.values[slot] = value if current is None else current + value
+
+    def accumulate(self, row, factor=1):
+        """Adds the line item values in the given DB row (starting with the first line item) multiplied by factor, ignoring NULL values."""
+        values = self.values
+        for i, value in enumerate(row):
+            if value:
+                values[i] += factor*value
+
+    def subtract(self, row):
+        """Subtracts the line item values in the given DB row (starting with the first line item) from all line items with a value, ignoring NULL values."""
+        values = self.values
+        for i, value in enumerate(row):
+            if value and values[i] is not None:
+                values[i] -= value
 
 gsRootDir = os.sep.join(os.path.abspath(__file__).split(os.sep)[:-2])
 
 reports = json.load(open(os.path.join(gsRootDir,'data','reports.json')))
-reports['balance'].update({'kind': 'balance', 'name': 'Balance Sheet', 'mappings': json.load(open(os.path.join(gsRootDir,'data','balance_mappings.json')))})
-reports['income'].update({'kind': 'income', 'name': 'Income Statement', 'mappings': json.load(open(os.path.join(gsRootDir,'data','income_mappings.json')))})
-reports['cashflow'].update({'kind': 'cashflow', 'name': 'Cashflow Statement', 'mappings': json.load(open(os.path.join(gsRootDir,'data','cashflow_mappings.json')))})
+reports['balance'].update({'kind': 'balance', 'name': 'Balance Sheet', 'mappings': concept_mappings.load_mappings('balance',reports['balance']['lineitems'])})
+reports['income'].update({'kind': 'income', 'name': 'Income Statement', 'mappings': concept_mappings.load_mappings('income',reports['income']['lineitems'])})
+reports['cashflow'].update({'kind': 'cashflow', 'name': 'Cashflow Statement', 'mappings': concept_mappings.load_mappings('cashflow',reports['cashflow']['lineitems'])})
+
+# Expense line items of the income statement which are stored as negative values
+income_expense_lineitems = ('costOfRevenue','researchAndDevelopment','sellingGeneralAndAdministrative','nonRecurring','operatingExpensesOther','operatingExpensesTotal','interestExpense','incomeTaxExpense','minorityInterest','preferredStockAndOtherAdjustments')
+for report in reports.values():
+    # Position of each line item in the LineItems vectors and DB rows of the report
+    report['slots'] = {lineitem: i for i, lineitem in enumerate(report['lineitems'])}
+
+# Columns of the DB tables holding the rows of a filing
+db_columns = {
+    'filings':            ['accessionNumber','cikNumber','companyName','formType','filingDate','fileNumber','acceptanceDatetime','period','assistantDirector','assignedSic','otherCikNumbers','fiscalYearEnd','instanceUrl','errors'],
+    'balance_sheet':      ['accessionNumber','cikNumber','endDate','currencyCode'] + reports['balance']['lineitems'],
+    'income_statement':   ['accessionNumber','cikNumber','endDate','duration','currencyCode'] + reports['income']['lineitems'],
+    'cashflow_statement': ['accessionNumber','cikNumber','endDate','duration','currencyCode'] + reports['cashflow']['lineitems'],
+    'ratios':             ['accessionNumber','cikNumber','endDate','kind'] + reports['ratios']['lineitems'],
+}
+
+# Tables with rows depending on a filing, which are deleted together with the filing
+filing_tables = ('facts','balance_sheet','income_statement','cashflow_statement','ratios')
+
+
+# SQLite settings for initial loads of large amounts of data (page_size only applies to new DBs)
+bulk_load_pragmas = ('page_size=65536','synchronous=OFF','cache_size=-262144','mmap_size=1073741824','temp_store=MEMORY')
+
+class DBConnections:
+    """Hands out one long-lived DB connection per thread, which is reused for all DB access of the thread.
+
+    Connections of threads that have finished are closed when the next connection is opened, all others by close()."""
+
+    def __init__(self, driver, name, bulk_load=False):
+        self.driver = driver
+        self.name = name
+        self.bulk_load = bulk_load and driver == 'sqlite'
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.generation = 0
+        if driver == 'sqlite':
+            import sqlite3
+            self.module = sqlite3
+        elif driver == 'odbc':
+            import pyodbc
+            self.module = pyodbc
+        if bulk_load and not self.bulk_load:
+            logger.warning('Ignoring --bulk-load for %s DB',driver)
+
+    def open(self):
+        """Returns a new connection, which is owned (and must be closed) by the caller."""
+        if self.driver == 'sqlite':
+            # Connections are only used by one thread at a time, but may be closed by another thread
+            con = self.module.connect(self.name,isolation_level=None,check_same_thread=False)
+            if self.bulk_load:
+                for pragma in bulk_load_pragmas:
+                    con.execute('PRAGMA '+pragma)
+            con.execute('PRAGMA journal_mode=WAL')
+            return con
+        return self.module.connect(self.name)
+
+    def __call__(self):
+        """Returns the connection of the current thread."""
+        generation, con = getattr(self.local,'connection',(None,None))
+        if con is None or generation != self.generation:
+            con = self.open()
+            with self.lock:
+                self.close_finished()
+                self.connections.append((threading.current_thread(),con))
+                self.local.connection = (self.generation,con)
+        return con
 
+    def close_finished(self):
+        """Closes the connections of all threads that have finished."""
+        for thread, con in [(thread, con) for thread, con in self.connections if not thread.is_alive()]:
+            self.connections.remove((thread,con))
+            con.close()
+
+    def close(self):
+        """Closes all connections handed out so far (threads open a new connection on their next DB access).
+
+        The bulk load settings only apply to the closed connections, so all connections opened afterwards use the default settings.
+        After a bulk load the write-ahead log is checkpointed (and synced to disk) with the default settings and the DB statistics are updated."""
+        with self.lock:
+            connections, self.connections = self.connections, []
+            self.generation += 1
+        for thread, con in connections:
+            con.close()
+
+        if self.bulk_load:
+            self.bulk_load = False
+            logger.info('Finishing bulk load: Checkpointing and analyzing DB')
+            con = self.module.connect(self.name,isolation_level=None)
+            try:
+                con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                con.execute('ANALYZE')
+            finally:
+                con.close()
 
-def setup_db_connect(driver,name):
-    """Returns a function object that can be used to connect to the DB. The function doesn't require any additional parameters as it stores the DB name/connection string using closure."""
+def setup_db_connect(driver,name,bulk_load=False):
+    """Returns a function object that can be used to connect to the DB. The function doesn't require any additional parameters and returns the long-lived connection of the calling thread."""
     logger.info('Using %s DB with DSN=%s',driver,name)
-    def connect_sqlite():
-        con = sqlite3.connect(name,isolation_level=None)
-        con.execute('PRAGMA journal_mode=WAL')
+    if bulk_load and driver == 'sqlite':
+        logger.info('Using bulk load DB settings: %s',', '.join(bulk_load_pragmas))
+    return DBConnections(driver,name,bulk_load)
+
+class DBWriter:
+    """Writes the results of all processing threads to the DB from a single thread holding one long-lived connection.
+
+    Each unit of work is the list of (sql, params) statements of one filing. Consecutive statements with the same SQL are
+    executed with executemany and many filings are committed in one transaction. On SQLite each filing is applied within
+    a savepoint, so a failing filing is rolled back without affecting the other filings of the transaction. Other DB
+    drivers commit each filing separately."""
+
+    def __init__(self, connect, batch_size=100, report_interval=60):
+        self.connect = connect
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        self.queue = queue.Queue(maxsize=4*batch_size)
+        self.thread = threading.Thread(target=self.run,name='db-writer')
+        self.thread.start()
+
+    def submit(self, name, statements):
+        """Queues the statements of one filing and returns a Future which is done once they have been committed."""
+        future = concurrent.futures.Future()
+        self.queue.put((name,statements,future))
+        return future
+
+    def flush(self):
+        """Waits until all statements submitted before have been committed."""
+        self.submit('flush',None).result()
+
+    def close(self):
+        """Commits all submitted statements and stops the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        con = self.connect()
+        savepoints = getattr(con,'isolation_level','') is None
+        pending = []
+        self.filings, self.rows, self.busy = 0, 0, 0.0
+        last_report = start = time.perf_counter()
+        try:
+            while True:
+                # Commit once the batch is full or no further work is queued
+                try:
+                    item = self.queue.get(block=not pending)
+                except queue.Empty:
+                    self.commit(con,pending)
+                    continue
+                if item is None:
+                    break
+                name, statements, future = item
+                if statements is None:
+                    pending.append((future,None))
+                    self.commit(con,pending)
+                    continue
+
+                t = time.perf_counter()
+                pending.append((future,self.apply(con,name,statements,savepoints)))
+                if len(pending) >= self.batch_size:
+                    self.commit(con,pending)
+                self.busy += time.perf_counter()-t
+
+                if time.perf_counter()-last_report > self.report_interval:
+                    last_report = time.perf_counter()
+                    self.report(last_report-start)
+            self.commit(con,pending)
+        finally:
+            con.close()
+        self.report(time.perf_counter()-start)
+
+    def apply(self, con, name, statements, savepoints):
+        """Executes the statements of one filing and returns None or the exception which caused the filing to be rolled back."""
+        try:
+            if savepoints:
+                bulk_ratios.begin(con)
+                con.execute('SAVEPOINT filing')
+            rows = execute_db_statements(con,statements)
+            if savepoints:
+                con.execute('RELEASE filing')
+            else:
+                con.commit()
+            self.filings += 1
+            self.rows += rows
+            return None
+        except Exception as e:
+            logger.exception('Failed writing %s to DB',name)
+            if savepoints:
+                con.execute('ROLLBACK TO filing')
+                con.execute('RELEASE filing')
+            else:
+                con.rollback()
+            return e
+
+    def commit(self, con, pending):
+        """Commits the current transaction and completes the futures of all filings written within it."""
+        error = None
+        try:
+            con.commit()
+        except Exception as e:
+            logger.exception('Failed committing %d filings to DB',len(pending))
+            error = e
+        for future, exception in pending:
+            exception = exception or error
+            if exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(None)
+        pending.clear()
+
+    def report(self, elapsed):
+        logger.info('DB writer: %d filings with %d rows written in %.1fs (%.1f filings/s, %.0f rows/s, %.0f%% busy)',self.filings,self.rows,elapsed,self.filings/elapsed if elapsed else 0,self.rows/elapsed if elapsed else 0,100*self.busy/elapsed if elapsed else 0)
+
+def execute_db_statements(con,statements):
+    """Executes the (sql, params) statements, consecutive statements with the same SQL with executemany, and returns the number of statements."""
+    for sql, group in itertools.groupby(statements,key=lambda statement: statement[0]):
+        con.executemany(sql,[statement[1] for statement in group])
+    return len(statements)
+
+class StagingDBs:
+    """Per-thread SQLite staging DBs, into which the processing threads write the rows of their filings without contending for the main DB.
+
+    Each staging DB has the same tables as the main DB. DELETE statements are applied to the staging DB and additionally recorded
+    in its deletions table, so that they can be applied to the main DB before the rows of the staging DB are merged into it."""
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.generation = 0
+        os.makedirs(directory,exist_ok=True)
+
+    def connection(self):
+        """Returns the connection to the staging DB of the current thread, which is created on first use."""
+        generation, con = getattr(self.local,'connection',(None,None))
+        if con is None or generation != self.generation:
+            import sqlite3
+            with db_connect() as main:
+                schema = [row[0] for row in main.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name IN (%s)" % ','.join(['?']*(len(filing_tables)+1)),('filings',)+filing_tables)]
+            with self.lock:
+                # A new unique file, so that staging DBs kept after a failed merge (of this or an earlier run) are never overwritten
+                fd, path = tempfile.mkstemp(prefix='staging-%d-' % os.getpid(),suffix='.db3',dir=self.directory)
+                os.close(fd)
+                # The staging DB is discarded if anything fails, so it doesn't need to be durable
+                con = sqlite3.connect(path,isolation_level=None,check_same_thread=False)
+                con.execute('PRAGMA synchronous=OFF')
+                con.execute('PRAGMA journal_mode=MEMORY')
+                for sql in schema:
+                    con.execute(sql)
+                con.execute('CREATE TABLE deletions (seq INTEGER PRIMARY KEY, statement TEXT, params TEXT)')
+                self.connections.append((path,con))
+                self.local.connection = (self.generation,con)
         return con
-    def connect_odbc():
-        return pyodbc.connect(name)
-    if driver == 'sqlite':
-        import sqlite3
-        return connect_sqlite
-    elif driver == 'odbc':
-        import pyodbc
-        return connect_odbc
+
+    def submit(self, name, statements):
+        """Writes the statements of one filing to the staging DB of the current thread in one transaction and returns a Future which is already done."""
+        future = concurrent.futures.Future()
+        con = self.connection()
+        try:
+            con.execute('BEGIN')
+            execute_db_statements(con,statements)
+            con.executemany('INSERT INTO deletions (statement, params) VALUES (?,?)',[(sql,json.dumps(list(params),default=str)) for sql, params in statements if sql.startswith('DELETE')])
+            con.commit()
+            future.set_result(None)
+        except Exception as e:
+            logger.exception('Failed writing %s to staging DB',name)
+            con.rollback()
+            future.set_exception(e)
+        return future
+
+    def merge(self, con):
+        """Merges all staging DBs of this run into the main DB (one transaction per staging DB) and removes them. Must only be called while no thread writes to a staging DB."""
+        with self.lock:
+            connections, self.connections = self.connections, []
+            self.generation += 1
+        for path, staging in connections:
+            staging.close()
+        self.merge_files(con,[path for path, staging in connections])
+
+    def leftovers(self):
+        """Returns the paths of all staging DBs in the folder which do not belong to this run (kept by an earlier run whose merge failed or was interrupted)."""
+        with self.lock:
+            current = set(path for path, con in self.connections)
+        return sorted(path for path in glob.glob(os.path.join(self.directory,'staging-*.db3')) if path not in current)
+
+    def merge_files(self, con, paths):
+        """Merges the given staging DB files into the main DB (one transaction per file) and removes them, files that cannot be merged are kept.
+        Returns a list of dicts with the accessionNumber, cikNumber, formType and period of the merged filings whose statements were calculated."""
+        merged = []
+        if not paths:
+            return merged
+
+        logger.info('Merging %d staging DBs into DB',len(paths))
+        start = time.perf_counter()
+        rows = 0
+        for path in paths:
+            con.execute('ATTACH DATABASE ? AS staging',(path,))
+            try:
+                filings = [{'accessionNumber': row[0], 'cikNumber': row[1], 'formType': row[2], 'period': bulk_ratios.as_date(row[3])} for row in con.execute('SELECT accessionNumber, cikNumber, formType, period FROM staging.filings WHERE accessionNumber IN (SELECT accessionNumber FROM staging.balance_sheet)')]
+                bulk_ratios.begin(con)
+                # Unqualified table names in the recorded statements refer to the main DB
+                for sql, params in con.execute('SELECT statement, params FROM staging.deletions ORDER BY seq').fetchall():
+                    con.execute(sql,json.loads(params))
+                for table in ('filings',)+filing_tables:
+                    rows += con.execute('INSERT OR REPLACE INTO main.%s SELECT * FROM staging.%s' % (table,table)).rowcount
+                con.commit()
+            except:
+                con.rollback()
+                logger.exception('Failed merging staging DB %s, the staging DB is kept (merge it with --merge-staging)',path)
+                con.execute('DETACH DATABASE staging')
+                continue
+            con.execute('DETACH DATABASE staging')
+            os.remove(path)
+            merged.extend(filings)
+        elapsed = time.perf_counter()-start
+        logger.info('Merged %d rows from staging DBs in %.1fs (%.0f rows/s)',rows,elapsed,rows/elapsed if elapsed else 0)
+        return merged
+
+    def close(self):
+        """Closes the connections to all staging DBs which were not merged (the files are kept)."""
+        with self.lock:
+            connections, self.connections = self.connections, []
+            self.generation += 1
+        for path, con in connections:
+            con.close()
+            logger.warning('Staging DB %s was not merged (merge it with --merge-staging)',path)
+
+def merge_staging_dbs():
+    """Merges the staging DBs (if used) into the main DB once all filings written to them are complete."""
+    if filing_writer is not db_writer:
+        db_writer.flush()
+        filing_writer.merge(db_connect())
+
+def merge_leftover_staging_dbs(tickers):
+    """Merges the staging DBs kept by earlier runs into the main DB, followed by the post-processing of the companies of the merged filings."""
+    paths = filing_writer.leftovers()
+    logger.info('Found %d staging DBs left over by earlier runs',len(paths))
+    if not paths:
+        return
+    db_writer.flush()
+    calculated = {}
+    for filing in filing_writer.merge_files(db_connect(),paths):
+        if filing['cikNumber'] in tickers:
+            filing['ticker'] = tickers[filing['cikNumber']]
+            calculated.setdefault(filing['cikNumber'],[]).append(filing)
+    post_process_filings(calculated)
+
+def begin_db_writes():
+    """Starts collecting the DB statements of the current filing in thread-local storage."""
+    tls.db_writes = []
+
+def db_write(sql,params):
+    """Adds a DB statement to the statements of the current filing, which are written by the DB writer thread."""
+    tls.db_writes.append((sql,params))
+
+def upsert_statements(table,keys,row):
+    """Returns the DB statements inserting the row into the table or replacing the existing row with the same key columns."""
+    columns = db_columns[table]
+    if db_connect.driver == 'sqlite':
+        return [(bulk_ratios.upsert_sql(table,columns,keys),row)]
+    # Other DB drivers delete the existing row within the same transaction
+    return [('DELETE FROM %s WHERE %s' % (table,' AND '.join(key+' = ?' for key in keys)),[row[columns.index(key)] for key in keys]),
+            ('INSERT INTO %s VALUES(%s)' % (table,','.join(['?']*len(row))),row)]
+
+def db_upsert(table,keys,row):
+    """Adds an upsert of the row into the table (see upsert_statements) to the statements of the current filing."""
+    tls.db_writes.extend(upsert_statements(table,keys,row))
+
+def db_delete_filings(condition,params,dependent_only=False):
+    """Adds the deletion of the filings matching the condition on the filings table and all rows depending on them to the statements of the current filing."""
+    for table in filing_tables:
+        db_write('DELETE FROM %s WHERE accessionNumber IN (SELECT accessionNumber FROM filings WHERE %s)' % (table,condition),params)
+    if not dependent_only:
+        db_write('DELETE FROM filings WHERE %s' % condition,params)
+
+def submit_db_writes(name,writer=None):
+    """Hands the collected DB statements of the current filing over to the DB writer thread (or the given writer) and returns a Future which is done once they have been committed."""
+    statements, tls.db_writes = tls.db_writes, None
+    return (writer or db_writer).submit(name,statements)
 
 def create_db_tables():
     """Create all the necessary DB tables."""
@@ -141,42 +546,140 @@ CREATE TABLE ratios (
     PRIMARY KEY (accessionNumber,kind)
 );""" % ','.join(key+' REAL' for key in reports['ratios']['lineitems']))
 
+            create_feed_updates_table(con)
+
             con.commit()
     except:
         logger.exception('Failed creating DB tables')
         raise RuntimeError('Failed creating DB tables')
 
-def create_db_indices():
-    """Create all the necessary DB indices."""
-    logger.info('Creating DB indices')
+def create_feed_updates_table(con,if_not_exists=False):
+    """Create the DB table storing the high-water mark of the last successful incremental update of each RSS feed."""
+    con.execute("""
+CREATE TABLE %s feed_updates (
+    feed VARCHAR(32) PRIMARY KEY,
+    acceptanceDatetime DATETIME,
+    accessionNumber CHAR(20)
+);""" % ('IF NOT EXISTS' if if_not_exists else ''))
+
+# Queries run by build_secdb for every filing or company
+sql_previous_filing = 'SELECT accessionNumber FROM filings WHERE cikNumber = ? AND period < ? ORDER BY period DESC'
+sql_year_filings = 'SELECT accessionNumber FROM filings WHERE cikNumber = ? AND period > ? AND period <= ?'
+sql_company_filings = 'SELECT accessionNumber, formType, period FROM filings WHERE cikNumber = ? AND period IS NOT NULL ORDER BY period'
+sql_company_statements = 'SELECT * FROM %s WHERE accessionNumber IN (SELECT accessionNumber FROM filings WHERE cikNumber = ?)'
+sql_period_filings = 'SELECT accessionNumber FROM filings WHERE cikNumber = ? AND period = ?'
+
+# The queries which must not scan a whole table
+db_workload_queries = (
+    sql_previous_filing,
+    sql_year_filings,
+    sql_company_filings,
+    sql_company_statements % 'income_statement',
+    sql_company_statements % 'cashflow_statement',
+    sql_period_filings,
+    'SELECT accessionNumber FROM filings WHERE accessionNumber = ?',
+    'SELECT * FROM balance_sheet WHERE accessionNumber = ?',
+    'SELECT * FROM income_statement WHERE accessionNumber = ? AND duration = 3',
+    'SELECT * FROM cashflow_statement WHERE accessionNumber = ? AND duration = 3',
+    'SELECT DISTINCT lineitem FROM facts WHERE accessionNumber = ? AND report = ? AND lineitem IS NOT NULL',
+    'DELETE FROM ratios WHERE accessionNumber = ? AND kind = ?',
+)
+
+# Secondary DB indices as (name, table, columns, required) tuples. Lookups by accessionNumber use the primary keys. The
+# covering index on filings answers all per-company time range queries above. Required indices are used by build_secdb
+# itself, all others only serve queries on the finished DB and are dropped during a bulk load and rebuilt at its end.
+db_indices = (
+    ('filings_cik_period', 'filings', 'cikNumber, period, formType, accessionNumber', True),
+    ('filings_company', 'filings', 'companyName', False),
+    ('balance_cik', 'balance_sheet', 'cikNumber', False),
+    ('income_cik', 'income_statement', 'cikNumber', False),
+    ('cashflow_cik', 'cashflow_statement', 'cikNumber', False),
+    ('ratios_cik', 'ratios', 'cikNumber', False),
+)
+
+def create_db_indices(indices=db_indices,if_not_exists=False):
+    """Create the given DB indices (by default all necessary DB indices)."""
+    logger.info('Creating DB indices %s',', '.join(index[0] for index in indices))
 
     try:
         with db_connect() as con:
             cur = con.cursor()
 
             # Create indices
-            cur.execute('CREATE INDEX income_cik ON income_statement (cikNumber);')
-            cur.execute('CREATE INDEX balance_cik ON balance_sheet (cikNumber);')
-            cur.execute('CREATE INDEX cashflow_cik ON cashflow_statement (cikNumber);')
-            cur.execute('CREATE INDEX ratios_cik ON ratios (cikNumber);')
-            cur.execute('CREATE INDEX filings_cik ON filings (cikNumber);')
-            cur.execute('CREATE INDEX filings_company ON filings (companyName);')
+            for name, table, columns, required in indices:
+                cur.execute('CREATE INDEX %s %s ON %s (%s);' % ('IF NOT EXISTS' if if_not_exists else '',name,table,columns))
 
             con.commit()
     except:
         logger.exception('Failed creating DB indices')
         raise RuntimeError('Failed creating DB indices')
 
+def drop_db_indices(indices):
+    """Drop the given DB indices if they exist."""
+    logger.info('Dropping DB indices %s',', '.join(index[0] for index in indices))
+    with db_connect() as con:
+        for name, table, columns, required in indices:
+            con.execute('DROP INDEX IF EXISTS %s' % name)
+        con.commit()
+
+def check_query_plans(con):
+    """Returns a list of (query, plan) tuples for all queries in db_workload_queries which scan a whole table (SQLite only)."""
+    scans = []
+    for query in db_workload_queries:
+        for row in con.execute('EXPLAIN QUERY PLAN '+query,[None]*query.count('?')):
+            detail = row[-1]
+            if re.match(r'SCAN (TABLE )?\w+$',detail):
+                scans.append((query,detail))
+    return scans
+
+def log_query_plans():
+    """Logs a warning for each query of the workload which is not answered using an index."""
+    with db_connect() as con:
+        for query, detail in check_query_plans(con):
+            logger.warning('Missing DB index: %s (query: %s)',detail,query)
+
+def load_feed_update(con,filepath):
+    """Returns the high-water mark recorded by the last successful incremental update of the RSS feed or None if there is none."""
+    row = con.execute('SELECT acceptanceDatetime, accessionNumber FROM feed_updates WHERE feed = ?',(os.path.basename(filepath),)).fetchone()
+    if not row:
+        return None
+    acceptanceDatetime = row[0]
+    if isinstance(acceptanceDatetime,str):
+        acceptanceDatetime = datetime.datetime.fromisoformat(acceptanceDatetime)
+    return (acceptanceDatetime,row[1])
+
+def store_feed_update(con,filepath,mark):
+    """Records the high-water mark of a successful incremental update of the RSS feed."""
+    feed = os.path.basename(filepath)
+    bulk_ratios.begin(con)
+    con.execute('DELETE FROM feed_updates WHERE feed = ?',(feed,))
+    con.execute('INSERT INTO feed_updates VALUES (?,?,?)',(feed,)+tuple(mark))
+    con.commit()
+
+def filings_since(filings,mark):
+    """Returns the filings that were accepted after the given high-water mark."""
+    if mark is None:
+        return list(filings)
+    return [filing for filing in filings if filing.get('acceptanceDatetime') and (filing['acceptanceDatetime'],filing['accessionNumber']) > mark]
+
+def stored_high_water_mark(con,filings,mark,tickers):
+    """Returns the high-water mark of the filings accepted after mark up to (excluding) the oldest SEC DB filing that is not stored in the DB.
+
+    Filings that failed to download or to process are thus retried by the next incremental update. A filing also counts as stored if it was replaced by a later amendment of the same period."""
+    new_filings = [filing for filing in filings_since(filings,mark) if filing.get('acceptanceDatetime')]
+    new_filings.sort(key=lambda filing: (filing['acceptanceDatetime'],filing['accessionNumber']))
+    for filing in new_filings:
+        if feed_tools.is_secdb_filing(filing,tickers,args.cik):
+            stored = con.execute('SELECT accessionNumber FROM filings WHERE accessionNumber = ? OR (cikNumber = ? AND period = ? AND formType = ? AND acceptanceDatetime > ?)',(filing['accessionNumber'],feed_tools.secdb_cik(filing),filing['period'],filing['formType'].split('/')[0],filing['acceptanceDatetime'])).fetchone()
+            if not stored:
+                logger.warning('Filing %s was not stored, high-water mark is kept before it',filing['accessionNumber'])
+                break
+        mark = (filing['acceptanceDatetime'],filing['accessionNumber'])
+    return mark
+
 def load_ticker_symbols():
     """Returns a dict of CIK to ticker symbol."""
-    logger.info('Loading ticker file %s','tickers.csv')
-
-    tickers = {}
-    with open(os.path.join(gsRootDir,'data','tickers.csv'),'r') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            tickers[int(row[1])] = row[0].split('^')[0]
-    return tickers
+    return feed_tools.load_ticker_symbols()
 
 def insert_ticker_symbols(tickers):
     """Writes ticker symbol and CIK pairs to the DB."""
@@ -278,102 +781,209 @@ def find_required_context(instance,dei_ns):
             return fact.context
     return None
 
+def period_key(period):
+    """Returns a hashable key for the given period aspect value."""
+    if period.period_type == xbrl.PeriodType.INSTANT:
+        return (period.period_type, period.instant)
+    elif period.period_type == xbrl.PeriodType.START_END:
+        return (period.period_type, period.start, period.end)
+    else:
+        return (period.period_type,)
+
+def duration_months(period):
+    """Returns the duration of the given start/end period aspect value in months."""
+    return round((period.end-period.start).days/30)
+
+class ContextIndex:
+    """Index of all contexts of an XBRL instance by period, built in a single pass over the contexts.
+
+    instants maps each instant date to the first context without xbrli:segment element, durations maps each (end, months) pair to the list of
+    start/end contexts without xbrli:segment element and dimension_contexts maps each period to a dict from the set of dimensions used by a context
+    to the list of (context, (dimension, member) pairs) tuples of all contexts with exactly these dimensions."""
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.instants = {}
+        self.durations = {}
+        self.dimension_contexts = {}
+        for context in instance.contexts:
+            dim_values = tuple((dim.dimension,dim.value) for dim in context.dimension_aspect_values)
+            if dim_values:
+                dimensions = frozenset(dimension for dimension, member in dim_values)
+                self.dimension_contexts.setdefault(period_key(context.period_aspect_value),{}).setdefault(dimensions,[]).append((context,dim_values))
+            if context.entity.segment:
+                continue
+            if context.period.is_instant():
+                self.instants.setdefault(context.period.instant.value,context)
+            elif context.period.is_start_end():
+                period = context.period.aspect_value
+                self.durations.setdefault((period.end,duration_months(period)),[]).append(context)
+
+def context_index(instance):
+    """Returns the context index of the given instance, which is built once for the filing processed by the current thread."""
+    index = getattr(tls,'context_index',None)
+    if index is None or index.instance is not instance:
+        index = tls.context_index = ContextIndex(instance)
+    return index
+
 def find_required_instant_context(instance,instant):
     """Returns the required instant context (with absent xbrli:segment element) for the given date."""
-    for context in instance.contexts:
-        if context.period.is_instant() and context.period.instant.value == instant and not context.entity.segment:
-            return context
-    return None
+    return context_index(instance).instants.get(instant)
+
+def find_duration_contexts(instance,end,duration):
+    """Returns a list of the required start/end contexts (with absent xbrli:segment element) ending at the given end date with the given duration in months."""
+    return context_index(instance).durations.get((end,duration),[])
 
 def find_dimension_contexts(instance,context,dimensions):
-    """Returns a list of contexts containing the given dimension values and having the same period as the given context."""
+    """Returns a list of contexts of the same entity and period as the given context whose dimension values are all contained in the given dict from dimension to allowed members."""
     contexts = []
-    for dimcontext in instance.contexts:
-        if dimcontext.period_aspect_value == context.period_aspect_value and dimcontext.entity_identifier_aspect_value == context.entity_identifier_aspect_value:
-            dim_values = list(dimcontext.dimension_aspect_values)
-            if dim_values:
-                matching_context = True
-                for dim in dim_values:
-                    if dim.dimension not in dimensions or dim.value not in dimensions[dim.dimension]:
-                        matching_context = False
-                        break
-                if matching_context:
-                    contexts.append(dimcontext)
+    for context_dimensions, dimcontexts in context_index(instance).dimension_contexts.get(period_key(context.period_aspect_value),{}).items():
+        # Skip all contexts using any other dimension at once
+        if not context_dimensions <= dimensions.keys():
+            continue
+        for dimcontext, dim_values in dimcontexts:
+            if dimcontext.entity_identifier_aspect_value == context.entity_identifier_aspect_value and all(member in dimensions[dimension] for dimension, member in dim_values):
+                contexts.append(dimcontext)
     return contexts
 
+class FactIndex:
+    """Index of all non-nil item facts of an XBRL instance by (concept, context), built in a single pass over the facts.
+
+    For each (concept, context) pair the first non-nil fact is kept (as with instance.facts.filter) and monetary facts are
+    additionally kept for each currency unit, so that looking up a value no longer filters all facts of the instance.
+    Values are only converted when they are looked up."""
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.facts = {}
+        self.monetary_facts = {}
+        for fact in instance.facts:
+            # Ignore tuples and xsi:nil facts
+            if not isinstance(fact, xbrl.Item) or fact.xsi_nil:
+                continue
+            key = (fact.concept, fact.context)
+            if key not in self.facts:
+                self.facts[key] = fact
+            if fact.concept.is_monetary():
+                currency = fact.unit_aspect_value.iso4217_currency
+                self.monetary_facts.setdefault(key+(currency,),fact)
+
+    def fact_value(self, concept, context):
+        """Returns the fact value found for the given concept and context."""
+        fact = self.facts.get((concept, context))
+        return fact.normalized_value if fact is not None else None
+
+    def numeric_value(self, concept, context):
+        """Returns the fact numeric value found for the given concept and context."""
+        fact = self.facts.get((concept, context))
+        return fact.effective_numeric_value if fact is not None else None
+
+    def monetary_value(self, concept, context, currency):
+        """Returns the fact value found for the given concept, context and currency."""
+        fact = self.monetary_facts.get((concept, context, currency))
+        return int(fact.effective_numeric_value) if fact is not None else None
+
+def fact_index(instance):
+    """Returns the fact index of the given instance, which is built once for the filing processed by the current thread."""
+    index = getattr(tls,'fact_index',None)
+    if index is None or index.instance is not instance:
+        index = tls.fact_index = FactIndex(instance)
+    return index
+
 def find_fact_value(instance, concept, context):
     """Returns the fact value found for the given concept and context."""
     if context:
-        facts = instance.facts.filter(concept, context)
-        for fact in facts:
-            # Check for xsi:nil facts
-            if fact.xsi_nil:
-                continue
-            return fact.normalized_value
+        return fact_index(instance).fact_value(concept, context)
     return None
 
 def find_numeric_value(instance, concept, context):
     """Returns the fact numeric value found for the given concept and context."""
     # Ignore non-numeric facts
     if concept.is_numeric() and context:
-        facts = instance.facts.filter(concept, context)
-        for fact in facts:
-            # Check for xsi:nil facts
-            if fact.xsi_nil:
-                continue
-            return fact.effective_numeric_value
+        return fact_index(instance).numeric_value(concept, context)
     return None
 
 def find_monetary_value(instance, concept, context, currency):
     """Returns the fact value found for the given concept, context and currency."""
     # Ignore non-monetary facts
     if concept.is_monetary() and context:
-        facts = instance.facts.filter(concept, context)
-        for fact in facts:
-            # Check for xsi:nil facts
-            if fact.xsi_nil:
-                continue
-            # Ignore facts reported with other currency units
-            unit = fact.unit_aspect_value
-            if unit.iso4217_currency == currency:
-                return int(fact.effective_numeric_value)
+        return fact_index(instance).monetary_value(concept, context, currency)
     return None
 
 
-def descendants(network,root,include_self=False):
-    """Returns a list of all descendant concepts form the given root."""
-    def _descendants(network,root,concepts):
-        concepts.append(root)
-        for rel in network.relationships_from(root):
-            _descendants(network,rel.target,concepts)
+class NetworkIndex:
+    """Wraps a network of relationships and caches the outgoing relationships and the set of descendants of each concept.
+
+    The descendants are computed iteratively (also for networks containing cycles) and reuse the already computed descendants
+    of any concept in the subtree, so marking whole subtrees as visited no longer walks the network again and again."""
+
+    def __init__(self, network):
+        self.network = network
+        self.roots = list(network.roots)
+        self.children = {}
+        self.subtrees = {}
+
+    def relationships_from(self, concept):
+        """Returns a list of all relationships with the given concept as source."""
+        rels = self.children.get(concept)
+        if rels is None:
+            rels = self.children[concept] = list(self.network.relationships_from(concept))
+        return rels
+
+    def relationships_to(self, concept):
+        """Returns an iterator over all relationships with the given concept as target."""
+        return self.network.relationships_to(concept)
+
+    def descendants(self, root):
+        """Returns a frozenset of all descendant concepts of the given root."""
+        subtree = self.subtrees.get(root)
+        if subtree is None:
+            concepts = set()
+            stack = [rel.target for rel in self.relationships_from(root)]
+            while stack:
+                concept = stack.pop()
+                if concept in concepts:
+                    continue
+                concepts.add(concept)
+                if concept in self.subtrees:
+                    concepts.update(self.subtrees[concept])
+                else:
+                    stack.extend(rel.target for rel in self.relationships_from(concept))
+            subtree = self.subtrees[root] = frozenset(concepts)
+        return subtree
 
-    concepts = []
+def descendants(network,root,include_self=False):
+    """Returns a set of all descendant concepts form the given root."""
+    if not isinstance(network,NetworkIndex):
+        network = NetworkIndex(network)
+    concepts = network.descendants(root)
     if include_self:
-        concepts.append(root)
-    for rel in network.relationships_from(root):
-        _descendants(network,rel.target,concepts)
+        concepts = concepts | {root}
     return concepts
 
 
 def presentation_concepts(dts,linkrole):
     """Returns a tuple with a list of all primary items and a dict of dimension domain values featured in the network of presentation relationships for the given linkrole."""
-    def _presentation_concepts(network,concept,preferred_label_role,level,concepts,dimensions):
+    concepts = []
+    dimensions = {}
+    network = NetworkIndex(dts.presentation_base_set(linkrole).network_of_relationships())
+    # Walk the network depth-first in document order with an explicit stack of (concept, preferred_label_role, level, ancestors) entries
+    stack = [(root,None,0,()) for root in reversed(network.roots)]
+    while stack:
+        concept, preferred_label_role, level, ancestors = stack.pop()
+        if concept in ancestors:
+            filing_logger.warning('Ignored cyclic presentation relationship to concept %s in linkrole %s',concept.qname,linkrole)
+            continue
         if isinstance(concept,xbrl.xdt.Dimension):
-            dimensions[concept] = set(descendants(network,concept))
-            return
+            dimensions[concept] = set(network.descendants(concept))
+            continue
 
         if isinstance(concept,xbrl.xdt.Hypercube):
             level -= 1
         else:
             concepts.append((concept,preferred_label_role,level))
-        for rel in network.relationships_from(concept):
-            _presentation_concepts(network,rel.target,rel.preferred_label,level+1,concepts,dimensions)
-
-    concepts = []
-    dimensions = {}
-    network = dts.presentation_base_set(linkrole).network_of_relationships()
-    for root in network.roots:
-        _presentation_concepts(network,root,None,0,concepts,dimensions)
+        ancestors += (concept,)
+        stack.extend((rel.target,rel.preferred_label,level+1,ancestors) for rel in reversed(network.relationships_from(concept)))
     return concepts, dimensions
 
 def concept_label(concept,label_role):
@@ -414,6 +1024,7 @@ def find_presentation_linkbase_values(filing, report, instance, linkrole, contex
         dim_contexts_stock = find_dimension_contexts(instance,context,{dim: dimensions[dim] for dim in dimensions if dim.name == 'StatementClassOfStockAxis'})
 
     fact_values = {}
+    fact_rows = []
     for i, (concept, preferred_label_role, level) in enumerate(concepts):
         # Skip abstract and non-monetary concepts
         if concept.abstract:
@@ -452,126 +1063,114 @@ def find_presentation_linkbase_values(filing, report, instance, linkrole, contex
         else:
             value = find_fact_value(instance, concept, context)
 
-        # Insert fact value to DB
+        # Keep fact row in memory, the line item is filled in by map_fact once the fact has been mapped
         if args.store_fact_mappings:
-            with db_connect() as con:
-                con.execute('INSERT INTO facts VALUES(?,?,?,?,?,?,?,?,?,?,?,?)',(filing['accessionNumber'],report['kind'],i,None,concept_label(concept,preferred_label_role),concept.target_namespace,concept.name,str(value),level,concept.abstract,is_total_role(preferred_label_role),is_negated_role(preferred_label_role)))
-                con.commit()
+            row = [filing['accessionNumber'],report['kind'],i,None,concept_label(concept,preferred_label_role),concept.target_namespace,concept.name,str(value),level,concept.abstract,is_total_role(preferred_label_role),is_negated_role(preferred_label_role)]
+            fact_rows.append(row)
+            if concept.name in fact_values and fact_values[concept.name]['pos'] == i:
+                fact_values[concept.name]['row'] = row
+
+    # Insert fact values to DB (executed in one batch when the filing is written, after all line items have been filled in)
+    for row in fact_rows:
+        db_write('INSERT INTO facts VALUES(?,?,?,?,?,?,?,?,?,?,?,?)',row)
 
     return fact_values
 
+def map_fact(value,lineitem):
+    """Sets the line item of the stored fact row of the given fact value (if fact mappings are stored)."""
+    row = value.get('row')
+    if row:
+        row[3] = lineitem
+
+# Line items of the current and non-current breakdowns of Assets and Liabilities (before and after the AssetsCurrent/LiabilitiesCurrent child)
+current_breakdowns = {
+    'Assets': ('AssetsCurrent',
+        (['cashAndCashEquivalents','shortTermInvestments','cashAndShortTermInvestments','receivablesNet','inventory','currentAssetsOther','currentAssetsTotal'],'currentAssetsOther'),
+        (['longTermInvestments','propertyPlantAndEquipmentGross','accumulatedDepreciation','propertyPlantAndEquipmentNet','goodwill','intangibleAssets','nonCurrrentAssetsOther','deferredLongTermAssetCharges','nonCurrentAssetsTotal'],'nonCurrrentAssetsOther')),
+    'Liabilities': ('LiabilitiesCurrent',
+        (['accountsPayable','shortTermDebt', 'currentLiabilitiesOther', 'currentLiabilitiesTotal'],'currentLiabilitiesOther'),
+        (['longTermDebt','capitalLeaseObligations', 'longTermDebtTotal', 'deferredLongTermLiabilityCharges', 'nonCurrentLiabilitiesOther', 'nonCurrentLiabilitiesTotal'],'nonCurrentLiabilitiesOther')),
+}
+
 def walk_calc_tree(filing,report,instance,network,concept,weight,fact_values,lineitem_values,allowed_lineitems,other_lineitem,visited_concepts):
     """Iterates over the concepts in the calculation tree and adds them to the appropriate report line items. If an unknown concept is encountered, it is added to the "other" line item of the current breakdown."""
 
-    if concept in visited_concepts:
-        visited_concepts.update(descendants(network,concept))
-        return
-    visited_concepts.add(concept)
-
-    lineitem = None
-    child_rels = list(network.relationships_from(concept))
-
-    value = fact_values.get(concept.name)
+    mappings = report['mappings']
+    # Walk the network depth-first in document order with an explicit stack of (concept, weight, allowed_lineitems, other_lineitem) entries
+    stack = [(concept,weight,allowed_lineitems,other_lineitem)]
+    while stack:
+        concept, weight, allowed_lineitems, other_lineitem = stack.pop()
 
-    current_mapping = report['mappings'].get(concept.name)
-    if current_mapping:
+        if concept in visited_concepts:
+            visited_concepts.update(descendants(network,concept))
+            continue
+        visited_concepts.add(concept)
 
-        if 'add-to' in current_mapping:
-            lineitem = current_mapping['add-to'][0]
-            for x in current_mapping['add-to']:
-                if x in allowed_lineitems:
-                    lineitem = x
-                    break
-        elif 'total' in current_mapping:
-            lineitem = current_mapping['total']
+        lineitem = None
+        child_rels = network.relationships_from(concept)
 
-        if lineitem and lineitem not in allowed_lineitems:
-            # log error
-            filing_logger.warning('%s: Concept %s is not expected to occur within breakdown of %s',report['name'],concept.qname,next(network.relationships_to(concept)).source.qname)
-            lineitem = None
+        value = fact_values.get(concept.name)
 
-        allowed_lineitems = allowed_lineitems & set(current_mapping['allowed'] if 'allowed' in current_mapping else [lineitem])
-        if len(allowed_lineitems) == 0:
-            # log error
-            filing_logger.warning('%s: Concept %s is not expected to occur within breakdown of %s',report['name'],concept.qname,next(network.relationships_to(concept)).source.qname)
+        current_mapping = mappings.resolve(concept.name,allowed_lineitems)
+        if current_mapping:
 
-        if 'other' in current_mapping:
-            other_lineitem = current_mapping.get('other')
+            lineitem = mappings.name(current_mapping.lineitem)
+            if not current_mapping.expected:
+                # log error
+                filing_logger.warning('%s: Concept %s is not expected to occur within breakdown of %s',report['name'],concept.qname,next(network.relationships_to(concept)).source.qname)
 
-        if value:
-            if not lineitem and not child_rels:
-                lineitem = other_lineitem
-            if lineitem:
-                # Insert mapping to DB
-                if args.store_fact_mappings:
-                    with db_connect() as con:
-                        con.execute('UPDATE facts SET lineitem = ? WHERE accessionNumber = ? AND report = ? AND pos = ?',(lineitem,filing['accessionNumber'],report['kind'],value['pos']))
-                        con.commit()
-
-                if 'total' in current_mapping:
-                    if lineitem in lineitem_values:
-                        # error if already set
-                        filing_logger.error('%s: Overwriting already set total value of concept %s',report['name'],concept.qname)
-                    lineitem_values[lineitem] = weight * value['value']
-                else:
-                    lineitem_values[lineitem] += weight * value['value']
-                    visited_concepts.update(descendants(network,concept))
-                    return
-            elif not child_rels:
+            allowed_lineitems = current_mapping.allowed
+            if not allowed_lineitems:
                 # log error
-                filing_logger.error('%s: Ignored value of inconsistent concept %s',report['name'],concept.qname)
-    else:
+                filing_logger.warning('%s: Concept %s is not expected to occur within breakdown of %s',report['name'],concept.qname,next(network.relationships_to(concept)).source.qname)
 
-        if value and not child_rels:
-            if other_lineitem:
-                # Insert mapping to DB
-                if args.store_fact_mappings:
-                    with db_connect() as con:
-                        con.execute('UPDATE facts SET lineitem = ? WHERE accessionNumber = ? AND report = ? AND pos = ?',(other_lineitem,filing['accessionNumber'],report['kind'],value['pos']))
-                        con.commit()
+            if current_mapping.other is not None:
+                other_lineitem = mappings.name(current_mapping.other)
 
-                # log unknown concept
-                filing_logger.warning('%s: Added value of unknown concept %s to %s',report['name'],concept.qname,other_lineitem)
-                lineitem_values[other_lineitem] += weight * value['value']
-            else:
-                # log error
-                filing_logger.error('%s: Ignored value of unknown concept %s',report['name'],concept.qname)
-            visited_concepts.update(descendants(network,concept))
-            return
+            if value:
+                if not lineitem and not child_rels:
+                    lineitem = other_lineitem
+                if lineitem:
+                    # Store mapping
+                    map_fact(value,lineitem)
+
+                    if current_mapping.total:
+                        if lineitem in lineitem_values:
+                            # error if already set
+                            filing_logger.error('%s: Overwriting already set total value of concept %s',report['name'],concept.qname)
+                        lineitem_values[lineitem] = weight * value['value']
+                    else:
+                        lineitem_values.add(lineitem,weight * value['value'])
+                        visited_concepts.update(descendants(network,concept))
+                        continue
+                elif not child_rels:
+                    # log error
+                    filing_logger.error('%s: Ignored value of inconsistent concept %s',report['name'],concept.qname)
+        else:
 
-    if concept.name == 'Assets':
-        rel_current = None
-        for rel in child_rels:
-            if rel.target.name == 'AssetsCurrent':
-                rel_current = rel
-                break
-        if rel_current:
-            allowed_lineitems = set(['cashAndCashEquivalents','shortTermInvestments','cashAndShortTermInvestments','receivablesNet','inventory','currentAssetsOther','currentAssetsTotal'])
-            other_lineitem = 'currentAssetsOther'
-            for rel in child_rels:
-                walk_calc_tree(filing,report,instance,network,rel.target,weight*int(rel.weight),fact_values,lineitem_values,allowed_lineitems,other_lineitem,visited_concepts)
-                if rel == rel_current:
-                    allowed_lineitems = set(['longTermInvestments','propertyPlantAndEquipmentGross','accumulatedDepreciation','propertyPlantAndEquipmentNet','goodwill','intangibleAssets','nonCurrrentAssetsOther','deferredLongTermAssetCharges','nonCurrentAssetsTotal'])
-                    other_lineitem = 'nonCurrrentAssetsOther'
-            return
-    if concept.name == 'Liabilities':
-        rel_current = None
-        for rel in child_rels:
-            if rel.target.name == 'LiabilitiesCurrent':
-                rel_current = rel
-                break
-        if rel_current:
-            allowed_lineitems = set(['accountsPayable','shortTermDebt', 'currentLiabilitiesOther', 'currentLiabilitiesTotal'])
-            other_lineitem = 'currentLiabilitiesOther'
-            for rel in child_rels:
-                walk_calc_tree(filing,report,instance,network,rel.target,weight*int(rel.weight),fact_values,lineitem_values,allowed_lineitems,other_lineitem,visited_concepts)
-                if rel == rel_current:
-                    allowed_lineitems = set(['longTermDebt','capitalLeaseObligations', 'longTermDebtTotal', 'deferredLongTermLiabilityCharges', 'nonCurrentLiabilitiesOther', 'nonCurrentLiabilitiesTotal'])
-                    other_lineitem = 'nonCurrentLiabilitiesOther'
-            return
+            if value and not child_rels:
+                if other_lineitem:
+                    # Store mapping
+                    map_fact(value,other_lineitem)
+
+                    # log unknown concept
+                    filing_logger.warning('%s: Added value of unknown concept %s to %s',report['name'],concept.qname,other_lineitem)
+                    lineitem_values.add(other_lineitem,weight * value['value'])
+                else:
+                    # log error
+                    filing_logger.error('%s: Ignored value of unknown concept %s',report['name'],concept.qname)
+                visited_concepts.update(descendants(network,concept))
+                continue
 
-    for rel in child_rels:
-        walk_calc_tree(filing,report,instance,network,rel.target,weight*int(rel.weight),fact_values,lineitem_values,allowed_lineitems,other_lineitem,visited_concepts)
+        children = [(rel.target,weight*int(rel.weight),allowed_lineitems,other_lineitem) for rel in child_rels]
+        if concept.name in current_breakdowns:
+            # The children up to the current breakdown (e.g. AssetsCurrent) belong to the current, all following children to the non-current line items
+            current_name, (current_lineitems, current_other), (noncurrent_lineitems, noncurrent_other) = current_breakdowns[concept.name]
+            current_pos = next((i for i, rel in enumerate(child_rels) if rel.target.name == current_name),None)
+            if current_pos is not None:
+                current_mask, noncurrent_mask = mappings.mask(current_lineitems), mappings.mask(noncurrent_lineitems)
+                children = [(target,child_weight)+((current_mask,current_other) if i <= current_pos else (noncurrent_mask,noncurrent_other)) for i, (target, child_weight, _, _) in enumerate(children)]
+        stack.extend(reversed(children))
 
 def calc_total_values(total_rules,lineitem_values,lineitem):
     """Calculates any missing (not directly reported) total values."""
@@ -589,40 +1188,30 @@ def calc_total_values(total_rules,lineitem_values,lineitem):
         lineitem_values[lineitem] = sum(values) if len(values) > 0 else None
 
 def calc_report_values(filing,report,instance,linkrole,fact_values):
-    """Returns a dict with the calculated values for each lineitem of the report."""
+    """Returns a LineItems vector with the calculated values for each lineitem of the report."""
 
-    lineitem_values = Summations()
+    lineitem_values = LineItems(report)
     visited_concepts = set()
 
     network = calculation_network(instance.dts,linkrole)
     if network:
+        network = NetworkIndex(network)
         for root in network.roots:
-            walk_calc_tree(filing,report,instance,network,root,1,fact_values,lineitem_values,set(report['lineitems']),None,visited_concepts)
+            walk_calc_tree(filing,report,instance,network,root,1,fact_values,lineitem_values,report['mappings'].mask(report['lineitems']),None,visited_concepts)
 
     visited_concept_names = set(concept.name for concept in visited_concepts)
     for concept_name, value in fact_values.items():
         if concept_name not in visited_concept_names:
 
-            lineitem = None
-
-            current_mapping = report['mappings'].get(concept_name)
-            if current_mapping:
-                if 'add-to' in current_mapping:
-                    lineitem = current_mapping['add-to'][0]
-                elif 'total' in current_mapping:
-                    lineitem = current_mapping['total']
-
+            lineitem = report['mappings'].default_lineitem(concept_name)
             if lineitem:
                 if lineitem not in lineitem_values:
-                    # Insert mapping to DB
-                    if args.store_fact_mappings:
-                        with db_connect() as con:
-                            con.execute('UPDATE facts SET lineitem = ? WHERE accessionNumber = ? AND report = ? AND pos = ?',(lineitem,filing['accessionNumber'],report['kind'],value['pos']))
-                            con.commit()
+                    # Store mapping
+                    map_fact(value,lineitem)
 
                     if lineitem == 'treasuryStockValue' and value['value'] > 0:
                         value['value'] *= -1
-                    lineitem_values[lineitem] += value['value']
+                    lineitem_values.add(lineitem,value['value'])
                 else:
                     # log error
                     filing_logger.warning('%s: Ignored value of concept %s outside of calculation tree to preserve totals',report['name'],value['concept'].qname)
@@ -630,11 +1219,6 @@ def calc_report_values(filing,report,instance,linkrole,fact_values):
                 # log unknown concept
                 filing_logger.warning('%s: Ignored value of unknown concept %s outside of calculation tree',report['name'],value['concept'].qname)
 
-    # Set missing/not reported values to None
-    for lineitem in report['lineitems']:
-        if lineitem not in lineitem_values:
-            lineitem_values[lineitem] = None
-
     for lineitem in report['totals']:
         calc_total_values(report['totals'],lineitem_values,lineitem)
 
@@ -675,13 +1259,10 @@ def calc_balance_sheet(filing,instance,context,linkroles):
 
     fact_values = find_presentation_linkbase_values(filing,reports['balance'],instance,linkrole,context,'USD')
     values = calc_report_values(filing,reports['balance'],instance,linkrole,fact_values)
-    values.update({'accessionNumber': filing['accessionNumber'], 'cikNumber': filing['cikNumber'], 'endDate': end_date(context), 'currencyCode': 'USD'})
 
     # Insert balance sheet into DB
-    with db_connect() as con:
-        db_fields = ['accessionNumber','cikNumber','endDate','currencyCode'] + reports['balance']['lineitems']
-        con.execute('INSERT INTO balance_sheet VALUES(%s)' % ','.join(['?']*len(db_fields)),[values[key] for key in db_fields])
-        con.commit()
+    db_values = [filing['accessionNumber'],filing['cikNumber'],end_date(context),'USD'] + values.values
+    db_write('INSERT INTO balance_sheet VALUES(%s)' % ','.join(['?']*len(db_values)),db_values)
 
 def calc_income_statement(filing,instance,context,linkroles):
     """Calculate income line items from XBRL instance and store in DB."""
@@ -698,7 +1279,7 @@ def calc_income_statement(filing,instance,context,linkroles):
     linkrole = linkroles[0]
 
     duration = 12 if filing['formType'] == '10-K' else 3
-    contexts = [context2 for context2 in instance.contexts if context2.period.is_start_end() and context2.period.aspect_value.end == context.period.aspect_value.end and round((context2.period.aspect_value.end-context2.period.aspect_value.start).days/30) == duration and not context2.entity.segment]
+    contexts = find_duration_contexts(instance,context.period.aspect_value.end,duration)
     if not contexts:
         filing_logger.error('%s: No required context found with %d month duration',reports['income']['name'],duration)
         return
@@ -706,35 +1287,18 @@ def calc_income_statement(filing,instance,context,linkroles):
 
     fact_values = find_presentation_linkbase_values(filing,reports['income'],instance,linkrole,context,'USD')
     values = calc_report_values(filing,reports['income'],instance,linkrole,fact_values)
-    values.update({'accessionNumber': filing['accessionNumber'], 'cikNumber': filing['cikNumber'], 'duration': duration, 'endDate': end_date(context), 'currencyCode': 'USD'})
 
-    for lineitem in ('costOfRevenue','researchAndDevelopment','sellingGeneralAndAdministrative','nonRecurring','operatingExpensesOther','operatingExpensesTotal','interestExpense','incomeTaxExpense','minorityInterest','preferredStockAndOtherAdjustments'):
-        if values[lineitem]:
-            values[lineitem] *= -1
+    negate_income_expenses(values)
 
     # Insert income statement into DB
-    with db_connect() as con:
-        db_fields = ['accessionNumber','cikNumber','endDate','duration','currencyCode'] + reports['income']['lineitems']
-        con.execute('INSERT INTO income_statement VALUES(%s)' % ','.join(['?']*len(db_fields)),[values[key] for key in db_fields])
-        con.commit()
+    db_values = [filing['accessionNumber'],filing['cikNumber'],end_date(context),duration,'USD'] + values.values
+    db_write('INSERT INTO income_statement VALUES(%s)' % ','.join(['?']*len(db_values)),db_values)
 
-        # Calculate data for the last quarter from the annual report
-        if filing['formType'] == '10-K':
-            previous_year_date = datetime.date(filing['period'].year-1,filing['period'].month,calendar.monthrange(filing['period'].year-1,filing['period'].month)[1])
-            previous_quarters = con.execute('SELECT * FROM income_statement WHERE duration = 3 AND accessionNumber IN (SELECT accessionNumber FROM filings WHERE cikNumber = ? AND formType = "10-Q" AND period BETWEEN ? AND ?)',(filing['cikNumber'],previous_year_date,filing['period'])).fetchall()
-
-            previous_quarters = {previous_quarter[2]: previous_quarter for previous_quarter in previous_quarters}   # ignore duplicate filings
-            if len(previous_quarters) == 3:
-                field_offset = len(db_fields)-len(reports['income']['lineitems'])
-                for i, lineitem in enumerate(reports['income']['lineitems']):
-                    if values[lineitem] is not None:
-                        for previous_quarter in previous_quarters.values():
-                            if previous_quarter[i+field_offset]:
-                                values[lineitem] -= previous_quarter[i+field_offset]
-
-                values['duration'] = 3
-                con.execute('INSERT INTO income_statement VALUES(%s)' % ','.join(['?']*len(db_fields)),[values[key] for key in db_fields])
-                con.commit()
+def negate_income_expenses(values):
+    """Negates the values of all expense line items of the income statement (stored as negative values in the DB)."""
+    for lineitem in income_expense_lineitems:
+        if values[lineitem]:
+            values[lineitem] *= -1
 
 def calc_cashflow_statement(filing,instance,context,linkroles):
     """Calculate cashflow line items from XBRL instance and store in DB."""
@@ -754,47 +1318,80 @@ def calc_cashflow_statement(filing,instance,context,linkroles):
 
     fact_values = find_presentation_linkbase_values(filing,reports['cashflow'],instance,linkrole,context,'USD')
     values = calc_report_values(filing,reports['cashflow'],instance,linkrole,fact_values)
-    values.update({'accessionNumber': filing['accessionNumber'], 'cikNumber': filing['cikNumber'], 'duration': duration, 'endDate': end_date(context), 'currencyCode': 'USD'})
 
     # Insert cash flow statement into DB
-    with db_connect() as con:
-        db_fields = ['accessionNumber','cikNumber','endDate','duration','currencyCode'] + reports['cashflow']['lineitems']
-        con.execute('INSERT INTO cashflow_statement VALUES(%s)' % ','.join(['?']*len(db_fields)),[values[key] for key in db_fields])
-        con.commit()
+    db_values = [filing['accessionNumber'],filing['cikNumber'],end_date(context),duration,'USD'] + values.values
+    db_write('INSERT INTO cashflow_statement VALUES(%s)' % ','.join(['?']*len(db_values)),db_values)
+
+def previous_month_end(period,months):
+    """Returns the last day of the month the given number of months before the period."""
+    month, year = period.month-months, period.year
+    while month < 1:
+        month += 12
+        year -= 1
+    return datetime.date(year,month,calendar.monthrange(year,month)[1])
+
+def derive_quarters(con,cik,ticker=None,accessions=None):
+    """Derives the 3 month income and cashflow statements of all filings of the company from the cumulative statements stored in the DB and returns the DB statements replacing the previously derived statements.
+
+    The last quarter of the financial year is derived from the annual report (10-K) and the three quarterly reports (10-Q) before it,
+    the current quarter of a compounded quarterly report (6 or 9 months) from the previous quarters. All derived statements of the
+    company are derived again and only the changed ones are replaced, so the result doesn't depend on the order in which the filings
+    were processed. Missing quarterly reports are only logged for the given accession numbers (or all filings if None)."""
+    filings = [(row[0],row[1],bulk_ratios.as_date(row[2])) for row in con.execute(sql_company_filings,(cik,))]
+
+    def log_error(accessionNumber,msg,*args):
+        if accessions is None or accessionNumber in accessions:
+            tls.filing = {'ticker': ticker, 'cikNumber': cik, 'accessionNumber': accessionNumber}
+            filing_logger.error(msg,*args)
+
+    db_statements = []
+    for report, table in ((reports['income'],'income_statement'),(reports['cashflow'],'cashflow_statement')):
+        # The statement as reported has the longest duration, any other 3 month statement was derived
+        rows = {}
+        for row in con.execute(sql_company_statements % table,(cik,)):
+            rows.setdefault(row[0],[]).append(row)
+        statements = {acc: max(rows[acc],key=lambda row: row[3]) for acc in rows}
+        previously_derived = {acc: list(row) for acc in rows for row in rows[acc] if row[3] == 3 and statements[acc][3] != 3}
+
+        # 3 month statements of quarterly reports as (period, accessionNumber, endDate, values) tuples, derived quarters are added in order of the period
+        quarters = [(period,acc,statements[acc][2],statements[acc][5:]) for acc, formType, period in filings if formType == '10-Q' and acc in statements and statements[acc][3] == 3]
+
+        derived = []
+        for acc, formType, period in filings:
+            row = statements.get(acc)
+            if not row or row[3] == 3:
+                continue
+            duration = row[3]
+            if formType == '10-K':
+                start, required = previous_month_end(period,12), 3
+            elif formType == '10-Q' and report['kind'] == 'cashflow':
+                start, required = previous_month_end(period,duration), duration/3 - 1
+            else:
+                continue
 
-        previous_quarters = None
-        # Calculate data for the current quarter
-        if filing['formType'] == '10-Q' and duration > 3:
-            month, year = filing['period'].month, filing['period'].year
-            month -= duration
-            if month < 1:
-                month += 12
-                year -= 1
-            previous_year_date = datetime.date(year,month,calendar.monthrange(year,month)[1])
-            previous_quarters = con.execute('SELECT * FROM cashflow_statement WHERE duration = 3 AND accessionNumber IN (SELECT accessionNumber FROM filings WHERE cikNumber = ? AND formType = "10-Q" AND period BETWEEN ? and ?)',(filing['cikNumber'],previous_year_date,filing['period'])).fetchall()
-            if len(previous_quarters) != (duration/3 - 1):
-                filing_logger.error('%s: Missing previous quarterly reports to calculate quarterly data from compounded quarterly report',reports['cashflow']['name'])
-                previous_quarters = None
-
-        # Calculate data for the last quarter of the financial year from the annual report
-        elif filing['formType'] == '10-K':
-            previous_year_date = datetime.date(filing['period'].year-1,filing['period'].month,calendar.monthrange(filing['period'].year-1,filing['period'].month)[1])
-            previous_quarters = con.execute('SELECT * FROM cashflow_statement WHERE duration = 3 AND accessionNumber IN (SELECT accessionNumber FROM filings WHERE cikNumber = ? AND formType = "10-Q" AND period BETWEEN ? and ?)',(filing['cikNumber'],previous_year_date,filing['period'])).fetchall()
-            if len(previous_quarters) != 3:
-                filing_logger.error('%s: Missing previous quarterly reports to calculate quarterly data from annual report',reports['cashflow']['name'])
-                previous_quarters = None
-
-        if previous_quarters:
-            field_offset = len(db_fields)-len(reports['cashflow']['lineitems'])
-            for i, lineitem in enumerate(reports['cashflow']['lineitems']):
-                if values[lineitem] is not None:
-                    for previous_quarter in previous_quarters:
-                        if previous_quarter[i+field_offset]:
-                            values[lineitem] -= previous_quarter[i+field_offset]
-
-            values['duration'] = 3
-            con.execute('INSERT INTO cashflow_statement VALUES(%s)' % ','.join(['?']*len(db_fields)),[values[key] for key in db_fields])
-            con.commit()
+            previous_quarters = [quarter for quarter in quarters if start <= quarter[0] <= period and quarter[1] != acc]
+            if report['kind'] == 'income':
+                previous_quarters = list({quarter[2]: quarter for quarter in previous_quarters}.values())   # ignore duplicate filings
+            if len(previous_quarters) != required:
+                if report['kind'] == 'cashflow':
+                    log_error(acc,'%s: Missing previous quarterly reports to calculate quarterly data from %s',report['name'],'annual report' if formType == '10-K' else 'compounded quarterly report')
+                continue
+
+            values = LineItems(report,row[5:])
+            for quarter in previous_quarters:
+                values.subtract(quarter[3])
+            derived.append([acc,cik,row[2],3,'USD'] + values.values)
+            if formType == '10-Q':
+                quarters.append((period,acc,row[2],values.values))
+
+        # Only write derived statements that changed and delete the ones that can no longer be derived
+        for values in derived:
+            if previously_derived.pop(values[0],None) != values:
+                db_statements.extend(upsert_statements(table,('accessionNumber','duration'),values))
+        for acc in previously_derived:
+            db_statements.append(('DELETE FROM %s WHERE accessionNumber = ? AND duration = 3' % table,(acc,)))
+    return db_statements
 
 def dbvalue(dbvalues,report,lineitem,avg_over_duration):
     if lineitem[0] == '-':
@@ -813,33 +1410,29 @@ def dbvalue(dbvalues,report,lineitem,avg_over_duration):
 def calc_ratios_mrq(filing):
     """Computes the ratios for the most recent quarter (mrq), annualized."""
     dbvalues = {
-        'previous_balance': Summations(),
-        'balance':          Summations(),
-        'income':           Summations(),
-        'cashflow':         Summations()
+        'previous_balance': LineItems.zeros(reports['balance']),
+        'balance':          LineItems.zeros(reports['balance']),
+        'income':           LineItems.zeros(reports['income']),
+        'cashflow':         LineItems.zeros(reports['cashflow'])
     }
     with db_connect() as con:
         factor = 4 if filing['formType'] == '10-Q' else 1
         # Fetch end balance sheet values from DB
         for row in con.execute('SELECT * FROM balance_sheet WHERE accessionNumber = ?',(filing['accessionNumber'],)):
-            for i, lineitem in enumerate(reports['balance']['lineitems']):
-                dbvalues['balance'][lineitem] += row[i+4] if row[i+4] else 0
+            dbvalues['balance'].accumulate(row[4:])
         # Fetch start balance sheet values from DB
-        previous_filing = con.execute('SELECT accessionNumber FROM filings WHERE cikNumber = ? AND period < ? ORDER BY period DESC',(filing['cikNumber'],filing['period'])).fetchone()
+        previous_filing = con.execute(sql_previous_filing,(filing['cikNumber'],filing['period'])).fetchone()
         if previous_filing:
             for row in con.execute('SELECT * FROM balance_sheet WHERE accessionNumber = ?',(previous_filing[0],)):
-                for i, lineitem in enumerate(reports['balance']['lineitems']):
-                    dbvalues['previous_balance'][lineitem] += row[i+4] if row[i+4] else 0
+                dbvalues['previous_balance'].accumulate(row[4:])
         # Fetch income statement values from DB
         for row in con.execute('SELECT * FROM income_statement WHERE accessionNumber = ?',(filing['accessionNumber'],)):
-            for i, lineitem in enumerate(reports['income']['lineitems']):
-                dbvalues['income'][lineitem] += factor*row[i+5] if row[i+5] else 0
+            dbvalues['income'].accumulate(row[5:],factor)
         # Fetch cashflow statement values from DB
         for row in con.execute('SELECT * FROM cashflow_statement WHERE accessionNumber = ?',(filing['accessionNumber'],)):
-            for i, lineitem in enumerate(reports['cashflow']['lineitems']):
-                dbvalues['cashflow'][lineitem] += factor*row[i+5] if row[i+5] else 0
+            dbvalues['cashflow'].accumulate(row[5:],factor)
 
-        values = {'accessionNumber': filing['accessionNumber'], 'cikNumber': filing['cikNumber'], 'endDate': filing['period'], 'kind': 'mrq'}
+        values = LineItems(reports['ratios'])
         for lineitem, ratio in reports['ratios']['formulas'].items():
             # Check if the average in assets/liabilities over the whole period should be used
             referenced_reports = set(op['report'] for op in itertools.chain(ratio['numerator'],ratio['denominator']))
@@ -850,51 +1443,46 @@ def calc_ratios_mrq(filing):
             denominator = sum(dbvalue(dbvalues,op['report'],op['lineitem'],avg_over_duration) for op in ratio['denominator'])
             values[lineitem] = numerator / denominator if denominator else None
 
-        # Insert ratios into DB
-        db_fields = ['accessionNumber','cikNumber','endDate','kind'] + reports['ratios']['lineitems']
-        con.execute('INSERT INTO ratios VALUES(%s)' % ','.join(['?']*len(db_fields)),[values[key] for key in db_fields])
-        con.commit()
+    # Insert ratios into DB
+    db_values = [filing['accessionNumber'],filing['cikNumber'],filing['period'],'mrq'] + values.values
+    db_upsert('ratios',('accessionNumber','kind'),db_values)
 
 def calc_ratios_ttm(filing):
     """Computes the ratios for the trailing twelve months (ttm)."""
     dbvalues = {
-        'balance':          Summations(),
-        'income':           Summations(),
-        'cashflow':         Summations()
+        'balance':          LineItems.zeros(reports['balance']),
+        'income':           LineItems.zeros(reports['income']),
+        'cashflow':         LineItems.zeros(reports['cashflow'])
     }
     previous_year_date = datetime.date(filing['period'].year-1,filing['period'].month,calendar.monthrange(filing['period'].year-1,filing['period'].month)[1])
 
     with db_connect() as con:
         # Fetch filings for the last year
-        previous_filings = con.execute('SELECT * FROM filings WHERE cikNumber = ? AND period > ? AND period <= ?',(filing['cikNumber'],previous_year_date,filing['period'])).fetchall()
+        previous_filings = con.execute(sql_year_filings,(filing['cikNumber'],previous_year_date,filing['period'])).fetchall()
         for previous_filing in previous_filings:
             # Fetch balance sheet values from DB
             for row in con.execute('SELECT * FROM balance_sheet WHERE accessionNumber = ?',(previous_filing[0],)):
-                for i, lineitem in enumerate(reports['balance']['lineitems']):
-                    dbvalues['balance'][lineitem] += row[i+4]/4 if row[i+4] else 0
+                dbvalues['balance'].accumulate(row[4:],1/4)
             # Fetch income statement values from DB
             for row in con.execute('SELECT * FROM income_statement WHERE accessionNumber = ? AND duration = 3',(previous_filing[0],)):
-                for i, lineitem in enumerate(reports['income']['lineitems']):
-                    dbvalues['income'][lineitem] += row[i+5] if row[i+5] else 0
+                dbvalues['income'].accumulate(row[5:])
             # Fetch cashflow statement values from DB
             for row in con.execute('SELECT * FROM cashflow_statement WHERE accessionNumber = ? AND duration = 3',(previous_filing[0],)):
-                for i, lineitem in enumerate(reports['cashflow']['lineitems']):
-                    dbvalues['cashflow'][lineitem] += row[i+5] if row[i+5] else 0
+                dbvalues['cashflow'].accumulate(row[5:])
 
-        values = {'accessionNumber': filing['accessionNumber'], 'cikNumber': filing['cikNumber'], 'endDate': filing['period'], 'kind': 'ttm'}
+        values = LineItems(reports['ratios'])
         for lineitem, ratio in reports['ratios']['formulas'].items():
             # Calculate the ratio
             numerator = sum(dbvalue(dbvalues,op['report'],op['lineitem'],False) for op in ratio['numerator'])
             denominator = sum(dbvalue(dbvalues,op['report'],op['lineitem'],False) for op in ratio['denominator'])
             values[lineitem] = numerator / denominator if denominator else None
 
-        # Insert ratios into DB
-        db_fields = ['accessionNumber','cikNumber','endDate','kind'] + reports['ratios']['lineitems']
-        con.execute('INSERT INTO ratios VALUES(%s)' % ','.join(['?']*len(db_fields)),[values[key] for key in db_fields])
-        con.commit()
+    # Insert ratios into DB
+    db_values = [filing['accessionNumber'],filing['cikNumber'],filing['period'],'ttm'] + values.values
+    db_upsert('ratios',('accessionNumber','kind'),db_values)
 
 def process_filing(filing):
-    """Load XBRL instance and store extracted data to DB."""
+    """Load XBRL instance and store extracted data to DB. Returns True if the financial statements of the filing were calculated."""
 
     # Store current filing in thread-local storage
     tls.filing = filing
@@ -902,33 +1490,36 @@ def process_filing(filing):
 
     with db_connect() as con:
         # Check if the filing was already processed
-        if con.execute('SELECT accessionNumber FROM filings WHERE accessionNumber = ?',(filing['accessionNumber'],)).fetchone():
-            if not args.recompute:
-                filing_logger.info('Skipped already processed filing')
-                return
-            filing_logger.info('Deleting existing filing %s',filing['accessionNumber'])
-            con.execute('DELETE FROM filings WHERE accessionNumber = ?',(filing['accessionNumber'],))
-            con.execute('DELETE FROM facts WHERE accessionNumber = ?',(filing['accessionNumber'],))
-            con.execute('DELETE FROM balance_sheet WHERE accessionNumber = ?',(filing['accessionNumber'],))
-            con.execute('DELETE FROM income_statement WHERE accessionNumber = ?',(filing['accessionNumber'],))
-            con.execute('DELETE FROM cashflow_statement WHERE accessionNumber = ?',(filing['accessionNumber'],))
-            con.execute('DELETE FROM ratios WHERE accessionNumber = ?',(filing['accessionNumber'],))
-            con.commit()
+        processed = con.execute('SELECT accessionNumber FROM filings WHERE accessionNumber = ?',(filing['accessionNumber'],)).fetchone()
+    if processed and not args.recompute:
+        filing_logger.info('Skipped already processed filing')
+        return
 
-        # Handle amendment filings
-        if filing['formType'].endswith('/A'):
-            filing['formType'] = filing['formType'][:-2]
-
-            # Delete the previous amended filing
-            for row in con.execute('SELECT accessionNumber FROM filings WHERE cikNumber = ? and period = ?',(filing['cikNumber'],filing['period'])):
-                filing_logger.info('Deleting amended filing %s',row[0])
-                con.execute('DELETE FROM filings WHERE accessionNumber = ?',(row[0],))
-                con.execute('DELETE FROM facts WHERE accessionNumber = ?',(row[0],))
-                con.execute('DELETE FROM balance_sheet WHERE accessionNumber = ?',(row[0],))
-                con.execute('DELETE FROM income_statement WHERE accessionNumber = ?',(row[0],))
-                con.execute('DELETE FROM cashflow_statement WHERE accessionNumber = ?',(row[0],))
-                con.execute('DELETE FROM ratios WHERE accessionNumber = ?',(row[0],))
-                con.commit()
+    # Make sure that the zip archive is intact before starting the expensive XBRL processing
+    archive = feed_tools.filing_archive_path(filing)
+    if archive and os.path.exists(archive):
+        error = feed_tools.verify_zip(archive)
+        if error:
+            filing_logger.error('Skipped filing with corrupt archive %s: %s',archive,error)
+            feed_tools.quarantine_file(archive)
+            download_manifest.Manifest().record_failure(filing['accessionNumber'],os.path.basename(os.path.dirname(archive)),filing.get('enclosureUrl'),archive,error,attempts=0,state=download_manifest.CORRUPT)
+            return
+
+    # All DB statements of the filing are collected and written at once by the DB writer thread
+    begin_db_writes()
+
+    if processed:
+        # The filing itself is replaced by an upsert below
+        filing_logger.info('Deleting existing filing %s',filing['accessionNumber'])
+        db_delete_filings('accessionNumber = ?',(filing['accessionNumber'],),dependent_only=True)
+
+    # Handle amendment filings
+    if filing['formType'].endswith('/A'):
+        filing['formType'] = filing['formType'][:-2]
+
+        # Delete the previous amended filing (selected by the DB writer, as the amended filing might not have been written yet)
+        filing_logger.info('Deleting amended filings of period %s',filing['period'])
+        db_delete_filings('cikNumber = ? AND period = ? AND accessionNumber <> ?',(filing['cikNumber'],filing['period'],filing['accessionNumber']))
 
     # Load XBRL instance from zip archive
     instance, log = feed_tools.load_instance(filing)
@@ -936,11 +1527,14 @@ def process_filing(filing):
     #filing['warnings'] = '\n'.join(error.text for error in itertools.chain(log.warnings, log.inconsistencies)) if log.has_warnings() or log.has_inconsistencies() else None
 
     # Write filing metadata into DB
-    with db_connect() as con:
-        con.execute('INSERT INTO filings VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)',[filing[key] for key in ('accessionNumber','cikNumber','companyName','formType','filingDate','fileNumber','acceptanceDatetime','period','assistantDirector','assignedSic','otherCikNumbers','fiscalYearEnd','instanceUrl','errors')])
-        con.commit()
+    db_upsert('filings',('accessionNumber',),[filing[key] for key in db_columns['filings']])
 
+    calculated = False
     if instance:
+        # Index all facts and contexts once, the indexes are shared by all financial statements of this filing
+        tls.fact_index = FactIndex(instance)
+        tls.context_index = ContextIndex(instance)
+
         # Find the appropriate linkroles for the main financial statements
         linkroles = classify_presentation_link_roles(instance.dts)
 
@@ -963,38 +1557,292 @@ def process_filing(filing):
             calc_income_statement(filing,instance,required_context,linkroles['income'])
             calc_cashflow_statement(filing,instance,required_context,linkroles['cashflow'])
 
-            # Calculate and store ratios to DB
-            calc_ratios_mrq(filing)
-            calc_ratios_ttm(filing)
+            # Quarterly statements and ratios are calculated after all filings of the company have been processed
+            calculated = True
         else:
             filing_logger.error('Missing or non-duration required context encountered')
+
+        # Release the instance held by the indexes
+        tls.fact_index = None
+        tls.context_index = None
     else:
         filing_logger.error('Invalid XBRL instance:\n%s',filing['errors'])
 
+    submit_db_writes('filing %s' % filing['accessionNumber'],filing_writer)
     filing_logger.info('Finished processing filing')
+    return calculated
 
-def process_filings_for_cik(cik,filings):
+def recompute_statement(con,filing,report,table):
+    """Recomputes the derived totals of the statement stored for the filing and returns a tuple with the line item values and the statement DB row (or None if there is no such statement).
+
+    Totals to which no fact was mapped (as stored in the facts table) were derived from the total rules and are calculated again using the current rules in reports.json.
+    All other line items keep their stored values, as the facts table lacks the calculation weights needed to sum them up again (changed concept mappings require reprocessing the filing)."""
+    offset = 4 if report['kind'] == 'balance' else 5
+    rows = con.execute('SELECT * FROM %s WHERE accessionNumber = ?' % table,(filing['accessionNumber'],)).fetchall()
+    if not rows:
+        return None
+    # The statement as reported has the longest duration, a 3 month statement of a compounded or annual report was derived from the previous quarters
+    row = max(rows,key=lambda row: row[3] if offset == 5 else 0)
+
+    reported = set(row[0] for row in con.execute('SELECT DISTINCT lineitem FROM facts WHERE accessionNumber = ? AND report = ? AND lineitem IS NOT NULL',(filing['accessionNumber'],report['kind'])))
+    values = LineItems(report,row[offset:])
+    if report['kind'] == 'income':
+        # Undo the negation of expenses, the total rules refer to the reported (positive) values
+        negate_income_expenses(values)
+    for lineitem in report['totals']:
+        if lineitem not in reported:
+            values[lineitem] = None
+    for lineitem in report['totals']:
+        calc_total_values(report['totals'],values,lineitem)
+    if report['kind'] == 'income':
+        negate_income_expenses(values)
+
+    if offset == 4:
+        condition, keys = 'accessionNumber = ?', [row[0]]
+    else:
+        condition, keys = 'accessionNumber = ? AND duration = ?', [row[0],row[3]]
+    db_write('UPDATE %s SET %s WHERE %s' % (table,','.join(lineitem+' = ?' for lineitem in report['lineitems']),condition),values.values+keys)
+    return values, row
+
+def recompute_filing_statements(con,filing):
+    """Recomputes the derived totals of the filing from the statements and facts stored in the DB."""
+    tls.filing = filing
+    if not con.execute('SELECT accessionNumber FROM facts WHERE accessionNumber = ? LIMIT 1',(filing['accessionNumber'],)).fetchone():
+        filing_logger.warning('Skipped recomputing statements: No facts stored in DB (see --store-fact-mappings)')
+        return
+    filing_logger.info('Recomputing statements')
+
+    begin_db_writes()
+    recompute_statement(con,filing,reports['balance'],'balance_sheet')
+    recompute_statement(con,filing,reports['income'],'income_statement')
+    recompute_statement(con,filing,reports['cashflow'],'cashflow_statement')
+    submit_db_writes('statements of filing %s' % filing['accessionNumber'])
+
+def recompute_statements_for_cik(cik,filings):
+    """Recomputes the statements of all given filings of the company followed by the quarterly statements of the company."""
+    con = db_connect()
+    for filing in filings:
+        try:
+            recompute_filing_statements(con,filing)
+        except:
+            logger.exception('Failed recomputing statements of filing %s',filing['accessionNumber'])
+    # The quarterly statements are derived from the recomputed statements
+    db_writer.flush()
+    db_writer.submit('quarterly statements of CIK %d' % cik,derive_quarters(con,cik,filings[0]['ticker'],set(filing['accessionNumber'] for filing in filings))).result()
+
+def recompute_statements(tickers,ciks=None,start=None,end=None):
+    """Recomputes the statements of all filings in the DB of the given CIKs (or all CIKs) with a period between start and end without reloading the XBRL instances."""
+    conditions, params = [], []
+    if ciks:
+        conditions.append('cikNumber IN (%s)' % ','.join(['?']*len(ciks)))
+        params.extend(ciks)
+    if start:
+        conditions.append('period >= ?')
+        params.append(start)
+    if end:
+        conditions.append('period <= ?')
+        params.append(end)
+    query = 'SELECT accessionNumber, cikNumber, formType, period FROM filings'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY period'
+
+    filings = {}
+    with db_connect() as con:
+        for accessionNumber, cikNumber, formType, period in con.execute(query,params):
+            filing = {'accessionNumber': accessionNumber, 'cikNumber': cikNumber, 'formType': formType, 'period': bulk_ratios.as_date(period), 'ticker': tickers.get(cikNumber)}
+            filings.setdefault(cikNumber,[]).append(filing)
+
+    logger.info('Start recomputing statements (count=%d)',sum(len(x) for x in filings.values()))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_threads) as executor:
+        futures = [executor.submit(recompute_statements_for_cik,cik,filings[cik]) for cik in filings]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except:
+                logger.exception('Exception occurred')
+    logger.info('Finished recomputing statements')
+
+def process_filing_chain(filings):
+    """Processes the given filings one after another and returns the list of filings whose financial statements were calculated."""
     #if filings[0]['companyName'] not in ('JOHNSON & JOHNSON','INTERNATIONAL BUSINESS MACHINES CORP','EXXON MOBIL CORP','CARNIVAL CORP','Google Inc.','AMAZON COM INC','APPLE INC','MICROSOFT CORP','ORACLE CORP','General Motors Co','GENERAL ELECTRIC CO','WAL MART STORES INC'):
-    #   return
+    #   return []
 
+    calculated = []
     for filing in filings:
         try:
-            process_filing(filing)
+            if process_filing(filing):
+                calculated.append(filing)
         except:
             logger.exception('Failed processing filing %s',filing['accessionNumber'])
+    return calculated
 
-def process_filings(filings):
-    """Distribute processing of filings over multiple threads/cores."""
-    logger.info('Start processing 10-K/10-Q filings (count=%d)',sum(len(x) for x in filings.values()))
+def post_process_filings_for_cik(cik,filings):
+    """Derives the quarterly statements of the company and calculates the ratios of the given filings after the raw statements of all filings have been stored."""
+    if not filings:
+        return
+    # Wait until the statements of all filings handed to the DB writer are stored
+    db_writer.flush()
+    db_writer.submit('quarterly statements of CIK %d' % cik,derive_quarters(db_connect(),cik,filings[0]['ticker'],set(filing['accessionNumber'] for filing in filings))).result()
+    for filing in filings:
+        tls.filing = filing
+        try:
+            begin_db_writes()
+            calc_ratios_mrq(filing)
+            calc_ratios_ttm(filing)
+            submit_db_writes('ratios of filing %s' % filing['accessionNumber'])
+        except:
+            logger.exception('Failed calculating ratios of filing %s',filing['accessionNumber'])
+
+def process_filings_for_cik(cik,filings):
+    """Processes all filings of the company one after another followed by the post-processing of the company."""
+    post_process_filings_for_cik(cik,process_filing_chain(filings))
+
+def filing_order(filing):
+    """Returns the sort key ordering filings by period, an amendment after the filings it replaces."""
+    return (filing['period'] or datetime.date.min, filing.get('acceptanceDatetime') or datetime.datetime.min, filing['accessionNumber'])
+
+def filing_chains(filings):
+    """Returns a list of lists of filings which must be processed one after another, ordered by CIK and period.
+
+    Only an amendment and the filings of the same company and period it replaces depend on each other, all other filings can be processed in parallel."""
+    chains = {}
+    for cik in sorted(filings):
+        for filing in sorted(filings[cik],key=filing_order):
+            chains.setdefault((cik,filing['period']),[]).append(filing)
+    return list(chains.values())
+
+def chain_costs(chains):
+    """Returns the estimated processing cost of each chain of filings, the total size of their zip archives (filings of unknown size count with the average size)."""
+    lengths = [filing['enclosureLength'] for chain in chains for filing in chain if filing.get('enclosureLength')]
+    default = sum(lengths)/len(lengths) if lengths else 1
+    return [sum(filing.get('enclosureLength') or default for filing in chain) for chain in chains]
+
+def run_scheduled(name,func,tasks):
+    """Calls func for the parameters of each (cost, params) task on multiple threads, starting with the most expensive tasks, and returns the results in the order of the tasks (None for failed tasks).
+
+    The utilization of the threads and the tail time, from the first thread running out of work until the last task finished, are written to the log."""
+    order = sorted(range(len(tasks)),key=lambda i: -tasks[i][0])
+    lock = threading.Lock()
+    busy, finished = {}, {}
+
+    def run(params):
+        started = time.perf_counter()
+        try:
+            return func(*params)
+        finally:
+            ended = time.perf_counter()
+            with lock:
+                thread = threading.get_ident()
+                busy[thread] = busy.get(thread,0)+ended-started
+                finished[thread] = ended
+
+    start = time.perf_counter()
+    results = [None]*len(tasks)
     with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_threads) as executor:
-        futures = [executor.submit(process_filings_for_cik,cik,filings[cik]) for cik in filings]
+        futures = {executor.submit(run,tasks[i][1]): i for i in order}
         for future in concurrent.futures.as_completed(futures):
             try:
-                future.result()
+                results[futures[future]] = future.result()
             except:
                 logger.exception('Exception occurred')
+    end = time.perf_counter()
+
+    if tasks:
+        elapsed = end-start
+        # Threads that never got a task were idle from the start
+        first_idle = min(finished.values()) if len(finished) >= args.max_threads else start
+        logger.info('%s: %d tasks on %d threads in %.1fs (%.0f%% utilization, %.1fs tail)',name,len(tasks),args.max_threads,elapsed,100*sum(busy.values())/(args.max_threads*elapsed) if elapsed else 0,end-first_idle)
+    return results
+
+def process_filings(filings):
+    """Distribute processing of filings over multiple threads/cores."""
+    logger.info('Start processing 10-K/10-Q filings (count=%d)',sum(len(x) for x in filings.values()))
+    chains = filing_chains(filings)
+    calculated = {}
+    for result in run_scheduled('Processing filings',process_filing_chain,[(cost,(chain,)) for cost, chain in zip(chain_costs(chains),chains)]):
+        for filing in result or []:
+            calculated.setdefault(filing['cikNumber'],[]).append(filing)
+
+    # Derive quarterly statements and calculate ratios once the raw statements of all filings are stored
+    merge_staging_dbs()
+    post_process_filings(calculated)
     logger.info('Finished processing 10-K/10-Q filings')
 
+def post_process_filings(calculated):
+    """Distribute the post-processing of the calculated filings (a dict of CIK to list of filings) over multiple threads/cores."""
+    run_scheduled('Post-processing filings',post_process_filings_for_cik,[(len(calculated[cik]),(cik,calculated[cik])) for cik in sorted(calculated)])
+
+def process_filings_pipelined(filepath,filings,tickers):
+    """Download any missing filing archives and process the filings of each CIK as soon as all of its archives are verified on disk.
+
+    Downloads run in a background thread and hand finished CIKs to the processing threads through a queue,
+    so that network transfers and XBRL processing overlap. The queue is unbounded as handing over a CIK must never block the downloads."""
+    logger.info('Start downloading and processing 10-K/10-Q filings (count=%d)',sum(len(x) for x in filings.values()))
+
+    manifest = download_manifest.Manifest()
+    downloads = download_filings.select_downloads(filepath,None,[filing for cik in filings for filing in filings[cik]],manifest)
+    pending, owners = {}, {}
+    for url, _, filing in downloads:
+        pending.setdefault(filing['cikNumber'],set()).add(url)
+        owners[url] = filing['cikNumber']
+    available = [cik for cik in filings if cik not in pending]
+    logger.info('%d CIKs are ready for processing, %d CIKs wait for %d downloads',len(available),len(pending),len(downloads))
+
+    ready = queue.Queue()
+    lock = threading.Lock()
+
+    def on_complete(url, filepath, attempts, error):
+        cik = owners[url]
+        with lock:
+            pending[cik].discard(url)
+            complete = not pending[cik]
+        if complete:
+            ready.put(cik)
+
+    def download():
+        try:
+            download_filings.download_selected(downloads,args,manifest,tickers,on_complete)
+        except:
+            logger.exception('Failed downloading filings')
+        finally:
+            # Never leave the processing stage waiting for CIKs whose downloads did not complete
+            with lock:
+                incomplete = [cik for cik in pending if pending[cik]]
+                for cik in incomplete:
+                    pending[cik].clear()
+            for cik in incomplete:
+                ready.put(cik)
+
+    downloader = threading.Thread(target=download,name='download')
+    downloader.start()
+
+    # With staging DBs the statements can only be post-processed once the staging DBs have been merged after all downloads
+    staging = filing_writer is not db_writer
+    chains = {}
+
+    slots = threading.BoundedSemaphore(args.max_threads)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_threads) as executor:
+        for i in range(len(filings)):
+            # Prefer CIKs whose downloads just finished, otherwise continue with filings that were already on disk
+            try:
+                cik = ready.get_nowait()
+            except queue.Empty:
+                cik = available.pop(0) if available else ready.get()
+            slots.acquire()
+            chain = sorted(filings[cik],key=filing_order)
+            if staging:
+                future = chains[cik] = executor.submit(process_filing_chain,chain)
+            else:
+                future = executor.submit(process_filings_for_cik,cik,chain)
+            future.add_done_callback(lambda future: slots.release())
+    downloader.join()
+
+    if staging:
+        merge_staging_dbs()
+        post_process_filings({cik: chains[cik].result() for cik in chains})
+    logger.info('Finished downloading and processing 10-K/10-Q filings')
+
 class FilingLogAdapter(logging.LoggerAdapter):
 
     def process(self, msg, kwargs):
@@ -1026,44 +1874,120 @@ def parse_args(daily_update=False):
     parser.add_argument('--cik', metavar='CIK', type=int, nargs='*', help='limit processing to only the specified CIK number')
     parser.add_argument('--recompute', default=False, action='store_true', help='recompute and replace filings already present in DB')
     parser.add_argument('--store-fact-mappings', default=False, action='store_true', help='stores original XBRL fact values and mappings to line items in DB')
+    parser.add_argument('--validate-feeds', default=False, action='store_true', help='validate the EDGAR RSS feeds against the RSS schema before reading them')
+    parser.add_argument('--use-index', default=False, action='store_true', help='select filings from the filings index instead of reading the EDGAR RSS feeds')
+    parser.add_argument('--skip-missing', default=False, action='store_true', help='skip filings whose archive is known to be missing according to the download manifest')
+    if not daily_update:
+        parser.add_argument('--bulk-load', default=False, action='store_true', help='use fast but unsafe SQLite settings for the connections of initial loads, the DB is checkpointed and analyzed at the end')
+        parser.add_argument('--staging-dir', metavar='DIR', help='write the filings of each thread to its own SQLite staging DB in the given folder and merge them into the DB at the end of each feed')
+        parser.add_argument('--merge-staging', default=False, action='store_true', help='first merge the staging DBs kept in --staging-dir by earlier runs (no other run may use the folder at the same time)')
+        parser.add_argument('--download', default=False, action='store_true', help='download missing filings and process each company as soon as its filings are on disk')
+        parser.add_argument('--rebuild-ratios', default=False, action='store_true', help='recompute the ratios of all filings in the DB in one bulk pass after processing (requires NumPy)')
+        parser.add_argument('--rebuild-statements', default=False, action='store_true', help='recompute derived totals and quarterly statements of all filings in the DB from the stored facts, followed by their ratios (requires NumPy)')
+        parser.add_argument('--period-from', metavar='YYYY-MM-DD', type=datetime.date.fromisoformat, help='limit --rebuild-ratios/--rebuild-statements to filings with a period on or after the given date')
+        parser.add_argument('--period-to', metavar='YYYY-MM-DD', type=datetime.date.fromisoformat, help='limit --rebuild-ratios/--rebuild-statements to filings with a period on or before the given date')
     if daily_update:
         parser.add_argument('--retries', type=int, default=3, dest='max_retries', help='specify max number of retries to download a specific filing')
+        parser.add_argument('--full-update', default=False, action='store_true', help='process all filings in the updated RSS feeds instead of only the filings accepted since the last successful update')
+        parser.add_argument('--for-secdb', default=False, action='store_true', help='download only the filings processed by build_secdb (10-K/10-Q filings of companies in tickers.csv)')
         parser.add_argument('--update-tickers', default=False, action='store_true', help='updates Ticker/CIK in --db')
     return parser.parse_args()
 
-def build_secdb(feeds):
+def build_secdb(feeds,feed_filings=None):
+    """Processes the filings in the given RSS feeds. If feed_filings is given (a dict from feed path to a list of filings), only those filings are processed instead of all filings in the feed."""
     # Setup python logging framework
     setup_logging(args.log_file)
 
     tickers = load_ticker_symbols()
 
     # Setup up DB connection
-    global db_connect
-    db_connect = setup_db_connect(args.db_driver,args.db_name)
+    global db_connect, db_writer, filing_writer
+    db_connect = setup_db_connect(args.db_driver,args.db_name,getattr(args,'bulk_load',False))
 
     # Create all required DB tables
-    if 'create_tables' in args:
-        if args.create_tables:
-            create_db_tables()
-            create_db_indices()
-            insert_ticker_symbols(tickers)
-
+    bulk_load = getattr(args,'bulk_load',False) and args.db_driver == 'sqlite'
+    deferred_indices = [index for index in db_indices if not index[3]] if bulk_load else []
+    if 'create_tables' in args and args.create_tables:
+        create_db_tables()
+        create_db_indices([index for index in db_indices if index not in deferred_indices])
+        insert_ticker_symbols(tickers)
+    elif args.db_driver == 'sqlite':
+        # Add indices introduced after the DB was created
+        create_db_indices([index for index in db_indices if index[3]],if_not_exists=True)
+    if deferred_indices:
+        # Indices not used while loading are rebuilt once at the end
+        drop_db_indices(deferred_indices)
+    if args.db_driver == 'sqlite':
+        log_query_plans()
+
+    # Filings that failed to download
+    missing = download_manifest.Manifest().missing() if args.skip_missing else set()
+
+    # All results are written to the DB by a single writer thread, the filings optionally to per-thread staging DBs first
+    db_writer = DBWriter(db_connect.open)
+    staging_dir = getattr(args,'staging_dir',None)
+    if staging_dir and args.db_driver != 'sqlite':
+        logger.warning('Ignoring --staging-dir for %s DB',args.db_driver)
+        staging_dir = None
+    filing_writer = StagingDBs(staging_dir) if staging_dir else db_writer
+    try:
+        if getattr(args,'merge_staging',False):
+            if staging_dir:
+                merge_leftover_staging_dbs(tickers)
+            else:
+                logger.warning('Ignoring --merge-staging without --staging-dir')
+        process_feeds(feeds,feed_filings,tickers,missing)
+    finally:
+        try:
+            if filing_writer is not db_writer:
+                filing_writer.close()
+            db_writer.close()
+            if deferred_indices:
+                # Also after a failure, as later runs rely on the indices being present
+                create_db_indices(deferred_indices,if_not_exists=True)
+        finally:
+            db_connect.close()
+
+def process_feeds(feeds,feed_filings,tickers,missing):
+    """Processes the filings in the given RSS feeds followed by the requested recomputations."""
     # Process all filings in the given RSS feeds one month after another
     for filepath in feeds:
 
         # Load EDGAR filing metadata from RSS feed (and filter out all non 10-K/10-Q filings or companies without an assigned ticker symbol)
+        if feed_filings is not None:
+            selected_filings = feed_filings[filepath]
+        elif args.use_index:
+            selected_filings = filings_index.select_filings([filepath],form_types=feed_tools.secdb_form_types,validate=args.validate_feeds)
+        else:
+            selected_filings = feed_tools.stream_feed(filepath,validate=args.validate_feeds)
+
         filings = {}
-        for filing in feed_tools.read_feed(filepath):
-            # Google to Alphabet reorganization
-            if filing['cikNumber'] == 1288776:
-                filing['cikNumber'] = 1652044
-            if args.cik is None or filing['cikNumber'] in args.cik:
-                if filing['formType'] in ('10-K','10-K/A','10-Q','10-Q/A') and filing['cikNumber'] in tickers:
-                    filing['ticker'] = tickers[filing['cikNumber']]
-                    filings.setdefault(filing['cikNumber'],[]).append(filing)
+        for filing in selected_filings:
+            if filing['accessionNumber'] in missing:
+                continue
+            if feed_tools.is_secdb_filing(filing,tickers,args.cik):
+                filing['cikNumber'] = feed_tools.secdb_cik(filing)
+                filing['ticker'] = tickers[filing['cikNumber']]
+                filings.setdefault(filing['cikNumber'],[]).append(filing)
 
         # Process the selected XBRL filings
-        process_filings(filings)
+        if getattr(args,'download',False):
+            process_filings_pipelined(filepath,filings,tickers)
+        else:
+            process_filings(filings)
+
+    # Recompute derived data from the statements and facts stored in the DB
+    rebuild_statements = getattr(args,'rebuild_statements',False)
+    if rebuild_statements:
+        recompute_statements(tickers,args.cik,args.period_from,args.period_to)
+    if rebuild_statements or getattr(args,'rebuild_ratios',False):
+        end = args.period_to
+        if rebuild_statements and end:
+            # The ratios of the following year also depend on the recomputed statements
+            end += datetime.timedelta(days=366)
+        db_writer.flush()
+        with db_connect() as con:
+            bulk_ratios.rebuild_ratios(con,reports,args.cik,args.period_from,end)
 
 def collect_feeds(args):
     """Returns an generator of the resolved, absolute RSS file paths."""
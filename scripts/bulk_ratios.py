@@ -0,0 +1,213 @@
+# Copyright 2015 Altova GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+__copyright__ = 'Copyright 2015 Altova GmbH'
+__license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
+
+# This module computes the mrq and ttm ratios of all filings in the SEC DB in one vectorized pass using NumPy.
+#
+# The balance sheet, income statement and cashflow statement tables are loaded into one array per table (one row per filing,
+# one column per line item) and the formulas in reports.json are compiled to column indices once. The results are the same
+# as computed by calc_ratios_mrq and calc_ratios_ttm in build_secdb.py for each filing, except that the previous filings are
+# always looked up among all filings in the DB (and not only among the filings processed before).
+
+import datetime,calendar,itertools,logging
+
+# create logger
+logger = logging.getLogger('default')
+
+def import_numpy():
+    """Returns the numpy module, which is only required for bulk ratio computation."""
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError('Bulk ratio computation requires NumPy (pip install numpy)')
+    return numpy
+
+def compile_formulas(reports):
+    """Returns a list of (lineitem, numerator, denominator, avg_over_duration) tuples for all ratios, where numerator and denominator are lists of (report, column, weight) tuples."""
+    formulas = []
+    for lineitem in reports['ratios']['lineitems']:
+        ratio = reports['ratios']['formulas'][lineitem]
+        terms = []
+        for ops in (ratio['numerator'],ratio['denominator']):
+            compiled = []
+            for op in ops:
+                name, weight = (op['lineitem'][1:], -1) if op['lineitem'][0] == '-' else (op['lineitem'], 1)
+                compiled.append((op['report'],reports[op['report']]['lineitems'].index(name),weight))
+            terms.append(compiled)
+        # Check if the average in assets/liabilities over the whole period should be used
+        referenced_reports = set(op['report'] for op in itertools.chain(ratio['numerator'],ratio['denominator']))
+        formulas.append((lineitem,terms[0],terms[1],len(referenced_reports) > 1 and 'balance' in referenced_reports))
+    return formulas
+
+def as_date(value):
+    """Returns the DB value of a DATE column as datetime.date."""
+    if isinstance(value,datetime.datetime):
+        return value.date()
+    if isinstance(value,datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+def previous_year_date(period):
+    """Returns the last day of the same month in the previous year."""
+    return datetime.date(period.year-1,period.month,calendar.monthrange(period.year-1,period.month)[1])
+
+class StatementArrays:
+    """Line item values of all filings loaded from the DB into NumPy arrays (one row per filing in the order of filings)."""
+
+    def __init__(self, con, reports, ciks=None):
+        np = import_numpy()
+
+        where, params = '', []
+        if ciks:
+            where = ' WHERE cikNumber IN (%s)' % ','.join(['?']*len(ciks))
+            params = list(ciks)
+
+        rows = con.execute('SELECT accessionNumber, cikNumber, period, formType FROM filings'+where,params).fetchall()
+        rows = [row for row in rows if row[2] is not None]
+        self.accession_numbers = [row[0] for row in rows]
+        self.index = {acc: i for i, acc in enumerate(self.accession_numbers)}
+        self.ciks = np.array([row[1] for row in rows],dtype=np.int64)
+        self.periods = [as_date(row[2]) for row in rows]
+        self.ordinals = np.array([period.toordinal() for period in self.periods],dtype=np.int64)
+        self.factors = np.array([4 if row[3] == '10-Q' else 1 for row in rows],dtype=np.float64)
+
+        n = len(rows)
+        self.balance = self.load(con,'balance_sheet',4,len(reports['balance']['lineitems']),where,params)
+        self.income = self.load(con,'income_statement',5,len(reports['income']['lineitems']),where,params)
+        self.income_quarter = self.load(con,'income_statement',5,len(reports['income']['lineitems']),where,params,'duration = 3')
+        self.cashflow = self.load(con,'cashflow_statement',5,len(reports['cashflow']['lineitems']),where,params)
+        self.cashflow_quarter = self.load(con,'cashflow_statement',5,len(reports['cashflow']['lineitems']),where,params,'duration = 3')
+
+        # Filings that were processed (have any statement or ratios), ratios are only computed for those
+        self.processed = np.zeros(n,dtype=bool)
+        for table in ('balance_sheet','income_statement','cashflow_statement','ratios'):
+            for row in con.execute('SELECT DISTINCT accessionNumber FROM %s%s' % (table,where),params):
+                if row[0] in self.index:
+                    self.processed[self.index[row[0]]] = True
+
+    def load(self, con, table, offset, count, where, params, condition=None):
+        """Returns an array with the sum of all rows of each filing in the given statement table, NULL values are treated as 0."""
+        np = import_numpy()
+        values = np.zeros((len(self.accession_numbers),count),dtype=np.float64)
+        if condition:
+            where = (where+' AND ' if where else ' WHERE ')+condition
+        rows, positions = [], []
+        for row in con.execute('SELECT * FROM %s%s' % (table,where),params):
+            i = self.index.get(row[0])
+            if i is not None:
+                positions.append(i)
+                rows.append([value or 0 for value in row[offset:offset+count]])
+        if rows:
+            np.add.at(values,np.array(positions,dtype=np.int64),np.array(rows,dtype=np.float64))
+        return values
+
+def compute_ratios(con, reports, ciks=None, start=None, end=None):
+    """Returns a list of ratio DB rows (accessionNumber, cikNumber, endDate, kind, ratios...) for all processed filings of the given CIKs (or all CIKs) with a period between start and end."""
+    np = import_numpy()
+    data = StatementArrays(con,reports,ciks)
+    n = len(data.accession_numbers)
+    if n == 0:
+        return []
+
+    # Sort filings by CIK and period, so that the previous filings of each filing are found by binary search
+    keys = data.ciks*(1 << 32) + data.ordinals
+    order = np.argsort(keys,kind='stable')
+    sorted_keys = keys[order]
+
+    # mrq: The balance sheet of the most recent filing of the same company with an earlier period
+    pos = np.searchsorted(sorted_keys,keys,side='left')-1
+    has_previous = (pos >= 0) & (data.ciks[order[np.maximum(pos,0)]] == data.ciks)
+    previous_balance = np.where(has_previous[:,None],data.balance[order[np.maximum(pos,0)]],0)
+
+    mrq = {
+        'balance':          data.balance,
+        'previous_balance': previous_balance,
+        'income':           data.income*data.factors[:,None],
+        'cashflow':         data.cashflow*data.factors[:,None],
+    }
+
+    # ttm: Sum over all filings of the same company within the last year (period after the same month in the previous year up to the period)
+    lower = data.ciks*(1 << 32) + np.array([previous_year_date(period).toordinal() for period in data.periods],dtype=np.int64)
+    lo = np.searchsorted(sorted_keys,lower,side='right')
+    hi = np.searchsorted(sorted_keys,keys,side='right')
+    def window_sum(values):
+        cumsum = np.vstack([np.zeros((1,values.shape[1])),np.cumsum(values[order],axis=0)])
+        return cumsum[hi]-cumsum[lo]
+    ttm = {
+        'balance':          window_sum(data.balance)/4,
+        'income':           window_sum(data.income_quarter),
+        'cashflow':         window_sum(data.cashflow_quarter),
+    }
+
+    def evaluate(values, terms, avg_over_duration):
+        result = np.zeros(n,dtype=np.float64)
+        for report, column, weight in terms:
+            if report == 'balance' and avg_over_duration:
+                result += weight*(values['previous_balance'][:,column]+values['balance'][:,column])/2
+            else:
+                result += weight*values[report][:,column]
+        return result
+
+    results = {'mrq': [], 'ttm': []}
+    for lineitem, numerator, denominator, avg_over_duration in compile_formulas(reports):
+        for kind, values in (('mrq',mrq),('ttm',ttm)):
+            avg = avg_over_duration and kind == 'mrq'
+            num, den = evaluate(values,numerator,avg), evaluate(values,denominator,avg)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                results[kind].append(np.where(den != 0,num/np.where(den != 0,den,1),np.nan))
+
+    selected = data.processed.copy()
+    if start:
+        selected &= data.ordinals >= start.toordinal()
+    if end:
+        selected &= data.ordinals <= end.toordinal()
+
+    rows = []
+    for kind in ('mrq','ttm'):
+        ratios = np.column_stack(results[kind]) if results[kind] else np.zeros((n,0))
+        for i in np.flatnonzero(selected):
+            rows.append([data.accession_numbers[i],int(data.ciks[i]),data.periods[i],kind] + [None if np.isnan(value) else float(value) for value in ratios[i]])
+    return rows
+
+def begin(con):
+    """Starts a transaction on SQLite connections opened in autocommit mode (other DB drivers start transactions implicitly)."""
+    if getattr(con,'isolation_level','') is None and not con.in_transaction:
+        con.execute('BEGIN')
+
+def upsert_sql(table, columns, keys):
+    """Returns an INSERT statement for all columns of the table, which replaces the existing row with the same key columns (SQLite 3.24 or later)."""
+    return 'INSERT INTO %s (%s) VALUES(%s) ON CONFLICT (%s) DO UPDATE SET %s' % (table,','.join(columns),','.join(['?']*len(columns)),','.join(keys),','.join('%s = excluded.%s' % (column,column) for column in columns if column not in keys))
+
+def write_ratios(con, reports, rows, batch_size=10000):
+    """Replaces the ratios of the given filings in the DB with the given ratio rows in batches."""
+    columns = ['accessionNumber','cikNumber','endDate','kind'] + reports['ratios']['lineitems']
+    for i in range(0,len(rows),batch_size):
+        batch = rows[i:i+batch_size]
+        begin(con)
+        if getattr(con,'isolation_level','') is None:
+            con.executemany(upsert_sql('ratios',columns,('accessionNumber','kind')),batch)
+        else:
+            con.executemany('DELETE FROM ratios WHERE accessionNumber = ? AND kind = ?',[(row[0],row[3]) for row in batch])
+            con.executemany('INSERT INTO ratios VALUES(%s)' % ','.join(['?']*len(batch[0])),batch)
+        con.commit()
+
+def rebuild_ratios(con, reports, ciks=None, start=None, end=None):
+    """Recomputes and replaces the mrq and ttm ratios of all processed filings of the given CIKs (or all CIKs) with a period between start and end."""
+    logger.info('Start computing ratios in bulk')
+    rows = compute_ratios(con,reports,ciks,start,end)
+    logger.info('Writing %d ratios to DB',len(rows))
+    write_ratios(con,reports,rows)
+    logger.info('Finished computing ratios in bulk')
+    return len(rows)
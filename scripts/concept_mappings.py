@@ -0,0 +1,255 @@
+# Copyright 2015 Altova GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+__copyright__ = 'Copyright 2015 Altova GmbH'
+__license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
+
+# This module compiles the concept mappings in data/*_mappings.json, which assign US-GAAP concepts to the line items of
+# the balance sheet, income statement and cashflow statement, into an optimized representation.
+#
+# Line items are replaced by integer ids and sets of allowed line items by bitmasks. The line item a concept is added to
+# within a given set of allowed line items is resolved once and then looked up from a resolution table. The compiled
+# mappings are cached in the data/cache subfolder until one of the JSON files changes.
+#
+# Run this script to check that the compiled mappings resolve all concepts exactly like the JSON mappings:
+#   python scripts/concept_mappings.py
+
+import os.path,json,pickle,collections,itertools,logging,sys
+
+# create logger
+logger = logging.getLogger('default')
+
+"""Returns the local directory representing the root directory."""
+root_dir = os.sep.join(os.path.abspath(__file__).split(os.sep)[:-2])
+
+"""Returns the local directory containing the report definitions and concept mappings."""
+data_dir = os.path.join(root_dir,'data')
+
+"""Returns the local directory where the compiled concept mappings will be cached."""
+mappings_cache_dir = os.path.join(data_dir,'cache')
+
+# Increment whenever the structure of the compiled mappings changes
+mappings_cache_version = 2
+
+# A concept mapping with line item ids: add_to is a tuple of line item ids, total and other a line item id or None and allowed a bitmask or None
+Mapping = collections.namedtuple('Mapping','add_to total allowed other')
+
+# The result of resolving a concept mapping within a set of allowed line items:
+# lineitem is the line item id (or None), expected is False if the line item is not allowed at this position,
+# allowed is the bitmask of line items allowed within the breakdown of the concept, other the id of the line item for unknown concepts in this breakdown (or None)
+Resolution = collections.namedtuple('Resolution','lineitem expected allowed other total')
+
+class CompiledMappings:
+    """Concept mappings of a report compiled to integer line item ids and bitmasks."""
+
+    def __init__(self, lineitems, mappings):
+        self.names = list(lineitems)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.mappings = {}
+        for concept_name, mapping in mappings.items():
+            self.mappings[concept_name] = Mapping(
+                tuple(self.id(name) for name in mapping.get('add-to',[])),
+                self.id(mapping['total']) if 'total' in mapping else None,
+                self.mask(mapping['allowed']) if 'allowed' in mapping else None,
+                self.id(mapping['other']) if 'other' in mapping else None)
+        self.all = self.mask(self.names)
+        self.resolutions = {}
+
+    @classmethod
+    def from_cache(cls, names, mappings):
+        """Returns the CompiledMappings for the plain data returned by to_cache."""
+        self = cls.__new__(cls)
+        self.names = list(names)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.mappings = {concept_name: Mapping(*mapping) for concept_name, mapping in mappings.items()}
+        self.all = self.mask(self.names)
+        self.resolutions = {}
+        return self
+
+    def to_cache(self):
+        """Returns a tuple with the line item names and the mappings as plain tuples.
+
+        Only builtin types are cached, as pickled classes would refer to __main__ when this module is run as a script.
+        The resolution table is filled on demand and not stored in the cache."""
+        return self.names, {concept_name: tuple(mapping) for concept_name, mapping in self.mappings.items()}
+
+    def id(self, name):
+        """Returns the id of the given line item name (line items referenced only by the mappings are appended)."""
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+    def mask(self, names):
+        """Returns the bitmask for the given line item names."""
+        mask = 0
+        for name in names:
+            mask |= 1 << self.id(name)
+        return mask
+
+    def lineitems(self, mask):
+        """Returns the set of line item names contained in the given bitmask."""
+        return set(name for i, name in enumerate(self.names) if mask & (1 << i))
+
+    def name(self, id):
+        """Returns the name of the line item with the given id or None."""
+        return self.names[id] if id is not None else None
+
+    def get(self, concept_name):
+        """Returns the compiled mapping of the given concept or None if the concept is unknown."""
+        return self.mappings.get(concept_name)
+
+    def default_lineitem(self, concept_name):
+        """Returns the name of the line item the concept is added to when occurring outside of the calculation tree (or None)."""
+        mapping = self.mappings.get(concept_name)
+        if mapping:
+            if mapping.add_to:
+                return self.names[mapping.add_to[0]]
+            elif mapping.total is not None:
+                return self.names[mapping.total]
+        return None
+
+    def resolve(self, concept_name, allowed):
+        """Returns the Resolution of the concept within the given bitmask of allowed line items or None if the concept is unknown."""
+        key = (concept_name, allowed)
+        resolution = self.resolutions.get(key)
+        if resolution is None:
+            mapping = self.mappings.get(concept_name)
+            if mapping is None:
+                return None
+
+            lineitem = None
+            if mapping.add_to:
+                lineitem = mapping.add_to[0]
+                for id in mapping.add_to:
+                    if allowed & (1 << id):
+                        lineitem = id
+                        break
+            elif mapping.total is not None:
+                lineitem = mapping.total
+
+            expected = True
+            if lineitem is not None and not allowed & (1 << lineitem):
+                expected = False
+                lineitem = None
+
+            if mapping.allowed is not None:
+                allowed &= mapping.allowed
+            else:
+                allowed &= (1 << lineitem) if lineitem is not None else 0
+
+            resolution = self.resolutions[key] = Resolution(lineitem, expected, allowed, mapping.other, mapping.total is not None)
+        return resolution
+
+def mappings_path(kind):
+    """Returns the path to the JSON file with the concept mappings of the given report kind."""
+    return os.path.join(data_dir,'%s_mappings.json'%kind)
+
+def mappings_cache_key(kind, lineitems):
+    """Returns a tuple identifying the current state of the JSON mappings (size and modification time) and the report line items."""
+    stat = os.stat(mappings_path(kind))
+    return (mappings_cache_version, kind, tuple(lineitems), stat.st_size, stat.st_mtime_ns)
+
+def mappings_cache_path(kind):
+    """Returns the path to the cache file of the compiled concept mappings."""
+    return os.path.join(mappings_cache_dir,'%s_mappings.pickle'%kind)
+
+def load_mappings(kind, lineitems, use_cache=True):
+    """Returns the CompiledMappings for the given report kind (balance, income or cashflow) and its list of line items."""
+    key = mappings_cache_key(kind, lineitems)
+    cachepath = mappings_cache_path(kind)
+    if use_cache:
+        try:
+            with open(cachepath,'rb') as f:
+                cached_key, cached = pickle.load(f)
+            if cached_key == key:
+                return CompiledMappings.from_cache(*cached)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.warning('Ignoring unreadable mappings cache %s',cachepath)
+
+    with open(mappings_path(kind)) as f:
+        mappings = CompiledMappings(lineitems, json.load(f))
+
+    if use_cache:
+        try:
+            os.makedirs(mappings_cache_dir,exist_ok=True)
+            # Write to a temporary file first so that concurrent readers never see a partially written cache file
+            tmppath = '%s.%d.tmp'%(cachepath,os.getpid())
+            with open(tmppath,'wb') as f:
+                pickle.dump((key,mappings.to_cache()),f,pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath,cachepath)
+        except OSError:
+            logger.warning('Failed writing mappings cache %s',cachepath)
+    return mappings
+
+def interpret_mapping(mapping, allowed_lineitems):
+    """Returns a (lineitem, expected, allowed_lineitems, other_lineitem, total) tuple by interpreting the JSON mapping as done in walk_calc_tree before the mappings were compiled."""
+    lineitem = None
+    if 'add-to' in mapping:
+        lineitem = mapping['add-to'][0]
+        for x in mapping['add-to']:
+            if x in allowed_lineitems:
+                lineitem = x
+                break
+    elif 'total' in mapping:
+        lineitem = mapping['total']
+
+    expected = True
+    if lineitem and lineitem not in allowed_lineitems:
+        expected = False
+        lineitem = None
+
+    allowed_lineitems = allowed_lineitems & set(mapping['allowed'] if 'allowed' in mapping else [lineitem])
+    return lineitem, expected, allowed_lineitems, mapping.get('other'), 'total' in mapping
+
+def check_equivalence(kind, lineitems):
+    """Returns a list of differences between the compiled and the interpreted JSON mappings of the given report kind."""
+    with open(mappings_path(kind)) as f:
+        mappings = json.load(f)
+    compiled = load_mappings(kind, lineitems)
+
+    # Check each concept within all line items, the allowed line items of each breakdown, each single line item and no line items
+    allowed_sets = [set(lineitems), set()]
+    allowed_sets.extend(set(mapping['allowed']) for mapping in mappings.values() if 'allowed' in mapping)
+    allowed_sets.extend({lineitem} for lineitem in lineitems)
+
+    differences = []
+    for (concept_name, mapping), allowed_lineitems in itertools.product(mappings.items(), allowed_sets):
+        resolution = compiled.resolve(concept_name, compiled.mask(allowed_lineitems))
+        actual = (compiled.name(resolution.lineitem), resolution.expected, compiled.lineitems(resolution.allowed), compiled.name(resolution.other), resolution.total)
+        expected = interpret_mapping(mapping, allowed_lineitems)
+        if actual != expected:
+            differences.append((concept_name, sorted(allowed_lineitems), actual, expected))
+        default_lineitem = mapping['add-to'][0] if 'add-to' in mapping else mapping.get('total')
+        if compiled.default_lineitem(concept_name) != default_lineitem:
+            differences.append((concept_name, None, compiled.default_lineitem(concept_name), default_lineitem))
+    return differences
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',level=logging.INFO)
+    with open(os.path.join(data_dir,'reports.json')) as f:
+        reports = json.load(f)
+
+    failed = False
+    for kind in ('balance','income','cashflow'):
+        differences = check_equivalence(kind, reports[kind]['lineitems'])
+        for difference in differences[:10]:
+            logger.error('%s: Compiled mapping of concept %s within %s resolves to %s instead of %s',kind,*difference)
+        logger.info('%s: %d differences between compiled and JSON mappings',kind,len(differences))
+        failed = failed or bool(differences)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
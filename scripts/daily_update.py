@@ -14,7 +14,7 @@
 __copyright__ = 'Copyright 2015 Altova GmbH'
 __license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
 
-import time, download_feeds, download_filings, build_secdb
+import time, download_feeds, download_filings, build_secdb, feed_tools
 import tickers_cik
 import sys
 
@@ -39,15 +39,40 @@ def main():
 		except:
 			build_secdb.logger.exception('Daily update ticker update failed') 
 
+	# The high-water marks are kept on a connection of their own, as build_secdb sets up and closes its connections for each feed
+	con = None
 	try:
 		feeds = download_feeds.download_feeds(build_secdb.args)
+		if not build_secdb.args.full_update:
+			con = build_secdb.setup_db_connect(build_secdb.args.db_driver,build_secdb.args.db_name).open()
+			build_secdb.create_feed_updates_table(con,if_not_exists=True)
+			con.commit()
+
 		for feed in feeds:
 			build_secdb.logger.info('Daily update of feed %s', feed)
-			download_filings.download_filings(feed,build_secdb.args)
-			build_secdb.build_secdb(feeds)
+			if build_secdb.args.full_update:
+				download_filings.download_filings(feed,build_secdb.args)
+				build_secdb.build_secdb([feed])
+				continue
+
+			# Only process filings accepted since the last successful update of this feed
+			feed_filings = feed_tools.read_feed(feed,validate=build_secdb.args.validate_feeds)
+			mark = build_secdb.load_feed_update(con,feed)
+			new_filings = build_secdb.filings_since(feed_filings,mark)
+			build_secdb.logger.info('Found %d new filings in feed %s since %s', len(new_filings), feed, mark)
+			if new_filings:
+				download_filings.download_filings(feed,build_secdb.args,new_filings)
+				build_secdb.build_secdb([feed],{feed: new_filings})
+				# Only advance the high-water mark past filings that were actually stored
+				new_mark = build_secdb.stored_high_water_mark(con,new_filings,mark,build_secdb.load_ticker_symbols())
+				if new_mark != mark:
+					build_secdb.store_feed_update(con,feed,new_mark)
 	except:
 		build_secdb.logger.exception('Daily update failed')
 		sys.exit(1)
+	finally:
+		if con is not None:
+			con.close()
 	build_secdb.logger.info('Daily update finished')
 
 
@@ -19,50 +19,64 @@ __license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
 # Usage:
 # 	raptorxmlxbrl script scripts/download_filings.py feeds/xbrlrss-2015-05.xml
 
-import feed_tools
-import sys,re,time,os.path,urllib.request,urllib.error,glob,logging,argparse,concurrent.futures
-import ssl
-from url_utils import mk_req
+import feed_tools, filings_index, async_download, download_manifest
+import sys,re,time,datetime,os.path,glob,logging,argparse
 
 def exists_filing(dir, url, length):
 	"""Returns True if the filing already has been downloaded."""
 	filepath = os.path.join(dir,url.split('/')[-1])
-	return os.path.exists(filepath) and (length is None or os.path.getsize(filepath) == length)
-
-def download_filing(dir, url, max_retries=3):
-	"""Download filing at url and store within the given dir."""
-
-	filepath = os.path.join(dir,url.split('/')[-1])
-	while max_retries > 0:
-		try:
-			logger.info('Downloading filing %s',url)
-			with urllib.request.urlopen( mk_req( url ), context=ssl.SSLContext() ) as f:
-				with open( filepath, 'wb' ) as O:
-					O.write( f.read() )
-
-		except OSError:
-			logger.info('Retry downloading filing %s',url)
-			max_retries -= 1
-			time.sleep(3)
-		else:
-			logger.info('Succeeded downloading filing %s',url)
-			return
-	logger.exception('Failed downloading filing %s',url)
+	if not os.path.exists(filepath):
+		return False
+	if length is not None:
+		return os.path.getsize(filepath) == length
+	# Without the expected length from the feed, check the integrity of the zip archive itself
+	error = verify_download(filepath)
+	if error:
+		logger.warning('Corrupt filing %s: %s',filepath,error)
+		feed_tools.quarantine_file(filepath)
+		return False
+	return True
+
+def is_downloaded(dir, filing, known, manifest):
+	"""Returns True if the filing archive already has been downloaded according to the manifest. Filings not yet recorded in the manifest are checked on disk (and recorded if present)."""
+	url, length, accessionNumber = filing['enclosureUrl'], filing['enclosureLength'], filing.get('accessionNumber')
+	if accessionNumber in known:
+		state, size = known[accessionNumber]
+		return state == download_manifest.DONE and (length is None or size == length)
+	if not exists_filing(dir,url,length):
+		return False
+	if manifest and accessionNumber:
+		manifest.record_download(accessionNumber,os.path.basename(dir),url,os.path.join(dir,url.split('/')[-1]),attempts=0)
+	return True
+
+def verify_download(filepath):
+	"""Returns None if the downloaded file is intact, otherwise a str describing the problem. Only zip archives are verified."""
+	if filepath.endswith('.zip') or filepath.endswith('.zip.part'):
+		return feed_tools.verify_zip(filepath)
+	return None
 
 def filings_dir(feedpath):
 	"""Returns the absolute directory path where filings for this feed will be stored."""
 	subdir = re.fullmatch(r'.*xbrlrss-(\d{4}-\d{2})\.xml',os.path.basename(feedpath)).group(1)
 	return os.path.join(feed_tools.filings_dir,subdir)
 
-def download_filings(feedpath,args=None):
-	"""Go through all entries in the given EDGAR RSS feed and download any missing or new filings."""
-	logger.info("Processing RSS feed %s",feedpath)
-
+def select_downloads(feedpath,args=None,filings=None,manifest=None,tickers=None):
+	"""Returns a list of (url, filepath, filing) tuples for all missing or new filings (and exhibits) in the given EDGAR RSS feed (or only the given filings of this feed)."""
+	for_secdb = getattr(args,'for_secdb',False)
 	dir = filings_dir(feedpath)
 	os.makedirs(dir,exist_ok=True)
 
-	filing_urls = []
-	for filing in feed_tools.read_feed(feedpath):
+	if filings is None:
+		validate = getattr(args,'validate_feeds',False)
+		if getattr(args,'use_index',False):
+			filings = filings_index.select_filings([feedpath],validate=validate)
+		else:
+			filings = feed_tools.read_feed(feedpath,validate=validate)
+
+	known = manifest.feed_states(os.path.basename(dir)) if manifest else {}
+
+	downloads = []
+	for filing in filings:
 		if args:
 			if args.company_re and not bool(args.company_re.match(filing['companyName'])):
 				continue
@@ -72,19 +86,68 @@ def download_filings(feedpath,args=None):
 				continue
 			if args.form_type and args.form_type != filing['formType']:
 				continue
-		if 'enclosureUrl' in filing and not exists_filing(dir,filing['enclosureUrl'],filing['enclosureLength']):
-			filing_urls.append(filing['enclosureUrl'])
-		if args and getattr(args,'with_exhibits',False):
-			filing_urls.extend( filing.get( 'exhibitList', [] ) )
-
-	logger.info("Start downloading %d new filings",len(filing_urls))
-	with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_threads) as executor:
-		futures = [executor.submit(download_filing,dir,url,args.max_retries) for url in filing_urls]
-		for future in concurrent.futures.as_completed(futures):
-			try:
-				future.result()
-			except Exception as e:
-				print(e)
+		if for_secdb and not feed_tools.is_secdb_filing(filing,tickers):
+			continue
+		if 'enclosureUrl' in filing and not is_downloaded(dir,filing,known,manifest):
+			downloads.append((filing['enclosureUrl'],os.path.join(dir,filing['enclosureUrl'].split('/')[-1]),filing))
+		if args and getattr(args,'with_exhibits',False) and not for_secdb:
+			downloads.extend((url,os.path.join(dir,url.split('/')[-1]),filing) for url in filing.get( 'exhibitList', [] ))
+	return downloads
+
+def download_priority(url,filing,tickers):
+	"""Returns the sort key of a download: 10-K/10-Q filings of companies in tickers.csv (as used by build_secdb) come first, then all other filings, each newest first. Exhibits follow their filings."""
+	preferred = feed_tools.is_secdb_filing(filing,tickers)
+	accepted = filing.get('acceptanceDatetime') or datetime.datetime.min
+	return (0 if preferred else 1, datetime.datetime.max-accepted, url != filing.get('enclosureUrl'))
+
+def download_selected(downloads,args=None,manifest=None,tickers=None,on_complete=None):
+	"""Downloads the given (url, filepath, filing) tuples as returned by select_downloads in the order of their priority and records the results in the manifest.
+	If given, on_complete is called with (url, filepath, attempts, error) after each download has finished (in a worker thread, not on the event loop)."""
+	priorities = {}
+	accession_numbers = {}
+	for url, filepath, filing in downloads:
+		priorities[url] = download_priority(url,filing,tickers if tickers is not None else {})
+		if url == filing.get('enclosureUrl'):
+			accession_numbers[url] = filing.get('accessionNumber')
+
+	def record_download(url, filepath, attempts, error):
+		accessionNumber = accession_numbers.get(url)
+		if manifest and accessionNumber:
+			feed = os.path.basename(os.path.dirname(filepath))
+			if error is None:
+				manifest.record_download(accessionNumber,feed,url,filepath,attempts)
+			else:
+				manifest.record_failure(accessionNumber,feed,url,filepath,error,attempts)
+		if on_complete:
+			on_complete(url,filepath,attempts,error)
+
+	logger.info("Start downloading %d new filings",len(downloads))
+	downloader = async_download.Downloader(
+		max_connections=getattr(args,'max_threads',8),
+		rate=getattr(args,'rate_limit',async_download.sec_max_requests_per_second),
+		max_retries=getattr(args,'max_retries',3),
+		verify=verify_download,
+		quarantine=feed_tools.quarantine_file,
+		on_complete=record_download)
+	downloader.download(((url,filepath) for url, filepath, filing in downloads),priority=lambda url, filepath: priorities[url])
+
+def download_feeds_filings(feeds,args=None):
+	"""Downloads any missing or new filings of all given (feedpath, filings) pairs with a single scheduler.
+
+	The filings of all feeds are queued into one priority queue which is worked off by one bounded pool of connections,
+	so that slow downloads of one month don't block the others. If filings is None, all filings in the feed are considered."""
+	manifest = download_manifest.Manifest() if not getattr(args,'no_manifest',False) else None
+	tickers = feed_tools.load_ticker_symbols()
+
+	downloads = []
+	for feedpath, filings in feeds:
+		logger.info("Processing RSS feed %s",feedpath)
+		downloads.extend(select_downloads(feedpath,args,filings,manifest,tickers))
+	download_selected(downloads,args,manifest,tickers)
+
+def download_filings(feedpath,args=None,filings=None):
+	"""Go through all entries in the given EDGAR RSS feed (or only the given filings of this feed) and download any missing or new filings."""
+	download_feeds_filings([(feedpath,filings)],args)
 
 def collect_feeds(args):
 	"""Returns an generator of the resolved, absolute RSS file paths."""
@@ -95,15 +158,21 @@ def collect_feeds(args):
 def parse_args():
 	"""Returns the arguments and options passed to the script."""
 	parser = argparse.ArgumentParser(description='Downloads all filings contained in the given EDGAR RSS feed from the SEC archive (skips already existing local files).')
-	parser.add_argument('rss_feeds', metavar='RSS', nargs='+', help='EDGAR RSS feed file')
+	parser.add_argument('rss_feeds', metavar='RSS', nargs='*', help='EDGAR RSS feed file')
 	parser.add_argument('--log', metavar='LOGFILE', dest='log_file', help='specify output log file')
 	parser.add_argument('--cik', help='CIK number')
 	parser.add_argument('--sic', help='SIC number')
 	parser.add_argument('--form-type', help='Form type (10-K,10-Q,...)')
 	parser.add_argument('--company', help='Company name')
-	parser.add_argument('--threads', type=int, default=8, dest='max_threads', help='specify max number of threads')
+	parser.add_argument('--threads', type=int, default=8, dest='max_threads', help='specify max number of concurrent connections')
+	parser.add_argument('--rate-limit', type=float, default=async_download.sec_max_requests_per_second, help='specify max number of requests per second (SEC fair access policy allows 10)')
 	parser.add_argument('--retries', type=int, default=3, dest='max_retries', help='specify max number of retries to download a specific filing')
 	parser.add_argument('--with-exhibits', action='store_true', help='download exhibits also')
+	parser.add_argument('--for-secdb', action='store_true', help='download only the filings processed by build_secdb (10-K/10-Q filings of companies in tickers.csv)')
+	parser.add_argument('--validate-feeds', action='store_true', help='validate the EDGAR RSS feeds against the RSS schema before reading them')
+	parser.add_argument('--use-index', action='store_true', help='select filings from the filings index instead of reading the EDGAR RSS feeds')
+	parser.add_argument('--no-manifest', action='store_true', help='check the downloaded files on disk instead of using the download manifest')
+	parser.add_argument('--show-failures', action='store_true', help='list all filings that failed to download according to the download manifest')
 	args = parser.parse_args()
 	args.company_re = re.compile(args.company, re.I) if args.company else None
 	if args.cik:
@@ -127,8 +196,12 @@ def main():
 	# Setup python logging framework
 	setup_logging(args.log_file)
 
-	for feedpath in collect_feeds(args.rss_feeds):
-		download_filings(feedpath,args)
+	if args.show_failures:
+		for accessionNumber, url, state, attempts, error, updated in download_manifest.Manifest().failures():
+			print('%s %-7s attempts=%d last=%s %s\n\t%s'%(accessionNumber,state,attempts,updated,url,error))
+		return
+
+	download_feeds_filings([(feedpath,None) for feedpath in collect_feeds(args.rss_feeds)],args)
 
 if __name__ == '__main__':
 	start = time.perf_counter()
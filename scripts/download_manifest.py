@@ -0,0 +1,115 @@
+# Copyright 2015 Altova GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+__copyright__ = 'Copyright 2015 Altova GmbH'
+__license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
+
+# This module maintains a SQLite manifest of all filing archives downloaded from the SEC archive.
+#
+# For each accession number the manifest records the download state, size, SHA-256 checksum, the number of attempts,
+# the last error and timestamps. This allows to decide which filings need to be fetched with a single query per feed
+# (instead of checking each file on disk) and to find filings that permanently fail to download.
+
+import feed_tools
+import os.path,sqlite3,hashlib,datetime,contextlib,logging
+
+# create logger
+logger = logging.getLogger('default')
+
+"""Returns the path to the SQLite file containing the download manifest."""
+manifest_path = os.path.join(feed_tools.filings_dir,'manifest.db3')
+
+# Download states
+DONE = 'done'
+FAILED = 'failed'
+CORRUPT = 'corrupt'
+
+def file_checksum(filepath):
+    """Returns the SHA-256 checksum of the file as hex string."""
+    sha256 = hashlib.sha256()
+    with open(filepath,'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+class Manifest:
+    """Provides access to the download manifest."""
+
+    def __init__(self, path=None):
+        self.path = path or manifest_path
+        os.makedirs(os.path.dirname(self.path),exist_ok=True)
+        with self.connect() as con:
+            con.executescript("""
+CREATE TABLE IF NOT EXISTS downloads (
+    accessionNumber CHAR(20) PRIMARY KEY,
+    feed CHAR(7),
+    url TEXT,
+    path TEXT,
+    state TEXT,
+    size INTEGER,
+    checksum CHAR(64),
+    attempts INTEGER DEFAULT 0,
+    lastError TEXT,
+    created DATETIME,
+    updated DATETIME
+);
+CREATE INDEX IF NOT EXISTS downloads_feed ON downloads (feed);
+CREATE INDEX IF NOT EXISTS downloads_state ON downloads (state);
+""")
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Returns a new connection to the manifest which is committed and closed at the end of the with block."""
+        con = sqlite3.connect(self.path,timeout=60)
+        try:
+            con.execute('PRAGMA journal_mode=WAL')
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def feed_states(self, feed):
+        """Returns a dict from accession number to a (state, size) tuple for all recorded filings of the given feed (YYYY-MM)."""
+        with self.connect() as con:
+            return {row[0]: (row[1],row[2]) for row in con.execute('SELECT accessionNumber, state, size FROM downloads WHERE feed = ?',(feed,))}
+
+    def _record(self, con, accessionNumber, feed, url, path, state, size, checksum, attempts, error):
+        now = datetime.datetime.now().isoformat(' ',timespec='seconds')
+        con.execute("""
+INSERT INTO downloads (accessionNumber,feed,url,path,state,size,checksum,attempts,lastError,created,updated) VALUES (?,?,?,?,?,?,?,?,?,?,?)
+ON CONFLICT (accessionNumber) DO UPDATE SET
+    feed = excluded.feed, url = excluded.url, path = excluded.path, state = excluded.state,
+    size = COALESCE(excluded.size,size), checksum = COALESCE(excluded.checksum,checksum),
+    attempts = attempts + excluded.attempts, lastError = excluded.lastError, updated = excluded.updated
+""",(accessionNumber,feed,url,path,state,size,checksum,attempts,error,now,now))
+
+    def record_download(self, accessionNumber, feed, url, path, attempts=1):
+        """Records a successfully downloaded and verified filing archive."""
+        size, checksum = os.path.getsize(path), file_checksum(path)
+        with self.connect() as con:
+            self._record(con,accessionNumber,feed,url,path,DONE,size,checksum,attempts,None)
+
+    def record_failure(self, accessionNumber, feed, url, path, error, attempts=1, state=FAILED):
+        """Records a failed or corrupt download of a filing archive."""
+        with self.connect() as con:
+            self._record(con,accessionNumber,feed,url,path,state,None,None,attempts,error)
+
+    def failures(self, min_attempts=1):
+        """Returns a list of (accessionNumber, url, state, attempts, lastError, updated) tuples of all filings that could not be downloaded, most attempts first."""
+        with self.connect() as con:
+            return con.execute("SELECT accessionNumber, url, state, attempts, lastError, updated FROM downloads WHERE state <> ? AND attempts >= ? ORDER BY attempts DESC, updated DESC",(DONE,min_attempts)).fetchall()
+
+    def missing(self):
+        """Returns a set of accession numbers whose archive is known to be missing (failed or corrupt download)."""
+        with self.connect() as con:
+            return set(row[0] for row in con.execute('SELECT accessionNumber FROM downloads WHERE state <> ?',(DONE,)))
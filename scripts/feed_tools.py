@@ -17,7 +17,8 @@ __license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
 # This module provides commonly used functionality to work with EDGAR RSS feeds.
 
 from altova_api.v2 import xml, xsd, xbrl
-import re,datetime,os.path,urllib.request,urllib.error,glob,logging
+from xml.etree import ElementTree
+import re,csv,datetime,os.path,urllib.request,urllib.error,glob,logging,pickle,time,zipfile,shutil
 import ssl
 from url_utils import mk_req
 
@@ -30,7 +31,8 @@ ex_re = re.compile('EX-(\d\d[^\d]|100)')
 # create logger
 logger = logging.getLogger('default')
 
-rss_schema = None
+# RSS schemas for the http and https EDGAR namespaces, keyed by schema file name
+rss_schemas = {}
 edgar_ns_list = ('http://www.sec.gov/Archives/edgar','https://www.sec.gov/Archives/edgar')
 
 """Returns the local directory representing the root directory."""
@@ -43,6 +45,18 @@ feed_dir = os.path.join(root_dir,'feeds')
 """Returns the local directory where all downloaded filings will be stored."""
 filings_dir = os.path.join(root_dir,'filings')
 
+"""Returns the path to the CSV file with ticker symbols and CIK numbers of all companies included in the SEC DB."""
+tickers_file = os.path.join(root_dir,'data','tickers.csv')
+
+"""Returns the local directory where corrupt filing archives will be moved to."""
+quarantine_dir = os.path.join(filings_dir,'quarantine')
+
+"""Returns the local directory where the parsed RSS feeds will be cached."""
+feed_cache_dir = os.path.join(feed_dir,'cache')
+
+# Increment whenever the structure of the filing dicts returned by parse_feed changes
+feed_cache_version = 2
+
 
 # General XBRL validation options
 xbrl_val_options = {
@@ -120,9 +134,8 @@ class Feed:
 
 def load_rss_schema( name ):
     """Returns an XML schema object of the RSS schema."""
-    global rss_schema
-    if rss_schema:
-        return rss_schema
+    if name in rss_schemas:
+        return rss_schemas[name]
 
     filepath = os.path.join(root_dir,'xsd',name)
     logger.info('Loading RSS schema %s',filepath)
@@ -133,6 +146,7 @@ def load_rss_schema( name ):
         error = 'Failed loading RSS schema: %s' % '\n'.join([error.text for error in log])
         logger.critical(error)
         raise RuntimeError(error)
+    rss_schemas[name] = rss_schema
     return rss_schema
 
 def load_feed(filepath):
@@ -244,18 +258,223 @@ def parse_feed(feed_instance):
                 filings.append(filing)
     return filings
 
-def read_feed(filepath):
-    """Return a list of dict objects with EDGAR meta information for each filing in the RSS feed."""
-    feed = load_feed(filepath)
-    return parse_feed(feed)
+def feed_cache_key(filepath):
+    """Returns a tuple identifying the current state of the RSS feed file (path, size and modification time)."""
+    stat = os.stat(filepath)
+    return (feed_cache_version, os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+
+def feed_cache_path(filepath):
+    """Returns the path to the cache file of the RSS feed."""
+    return os.path.join(feed_cache_dir,os.path.splitext(os.path.basename(filepath))[0]+'.pickle')
+
+def read_cached_feed(filepath):
+    """Returns the cached list of filings for the RSS feed or None if the cache is missing or outdated."""
+    cachepath = feed_cache_path(filepath)
+    try:
+        with open(cachepath,'rb') as f:
+            key, filings = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.warning('Ignoring unreadable feed cache %s',cachepath)
+        return None
+    if key != feed_cache_key(filepath):
+        logger.info('Feed cache %s is outdated',cachepath)
+        return None
+    return filings
+
+def write_cached_feed(filepath,filings):
+    """Stores the list of filings for the RSS feed in the cache."""
+    os.makedirs(feed_cache_dir,exist_ok=True)
+    cachepath = feed_cache_path(filepath)
+    # Write to a temporary file first so that concurrent readers never see a partially written cache file
+    tmppath = '%s.%d.tmp'%(cachepath,os.getpid())
+    with open(tmppath,'wb') as f:
+        pickle.dump((feed_cache_key(filepath),filings),f,pickle.HIGHEST_PROTOCOL)
+    os.replace(tmppath,cachepath)
+
+def collapse_whitespace(text):
+    """Returns the text with whitespace collapsed as done by XML schema for all types except xs:string (e.g. xs:anyURI and xs:boolean)."""
+    return ' '.join(text.split())
+
+def etree_child_text(elem,tag):
+    """Returns the text content of the child element or None if there is no such child element.
+
+    All text elements of the EDGAR RSS schema are of type xs:string, whose whitespace is preserved (like schema_actual_value in parse_feed)."""
+    child = elem.find(tag)
+    if child is not None:
+        return child.text or ''
+    return None
 
-def read_feeds(filepaths):
+def etree_child_as_int(elem,tag):
+    """Returns the content of the child element as int."""
+    text = etree_child_text(elem,tag)
+    if text is not None:
+        return int(text)
+    return None
+
+def etree_child_as_date(elem,tag,format):
+    """Returns the content of the child element as date."""
+    text = etree_child_text(elem,tag)
+    if text is not None:
+        return datetime.datetime.strptime(text.strip(),format).date()
+    return None
+
+def etree_child_as_datetime(elem,tag,format):
+    """Returns the content of the child element as datetime."""
+    text = etree_child_text(elem,tag)
+    if text is not None:
+        return datetime.datetime.strptime(text.strip(),format)
+    return None
+
+def parse_feed_item(item,dir):
+    """Returns a dict object with the EDGAR meta information of the given ElementTree <item> element."""
+    filing = {}
+
+    enclosure = item.find('enclosure')
+    if enclosure is not None:
+        filing['enclosureUrl'] = collapse_whitespace(enclosure.get('url'))
+        filing['enclosureLength'] = int(enclosure.get('length'))
+    else:
+        # fallback to value of <link> s/index.htm/xbrl.zip/
+        link = item.find('link')
+        if link is not None:
+            filing['enclosureUrl'] = collapse_whitespace(link.text or '').replace('index.htm', 'xbrl.zip')
+            filing['enclosureLength'] = None
+
+    for edgar_ns in edgar_ns_list:
+        xbrlFiling = item.find('{%s}xbrlFiling'%edgar_ns)
+        if xbrlFiling is not None:
+            break
+    else:
+        return filing
+
+    ns = '{%s}'%edgar_ns
+    filing['companyName'] = etree_child_text(xbrlFiling,ns+'companyName')
+    filing['formType'] = etree_child_text(xbrlFiling,ns+'formType')
+    filing['filingDate'] = etree_child_as_date(xbrlFiling,ns+'filingDate','%m/%d/%Y')
+    filing['cikNumber'] = etree_child_as_int(xbrlFiling,ns+'cikNumber')
+    filing['accessionNumber'] = etree_child_text(xbrlFiling,ns+'accessionNumber')
+    filing['fileNumber'] = etree_child_text(xbrlFiling,ns+'fileNumber')
+    filing['acceptanceDatetime'] = etree_child_as_datetime(xbrlFiling,ns+'acceptanceDatetime','%Y%m%d%H%M%S')
+    filing['period'] = etree_child_as_date(xbrlFiling,ns+'period','%Y%m%d')
+    filing['assistantDirector'] = etree_child_text(xbrlFiling,ns+'assistantDirector')
+    filing['assignedSic'] = etree_child_as_int(xbrlFiling,ns+'assignedSic')
+    filing['otherCikNumbers'] = etree_child_text(xbrlFiling,ns+'otherCikNumbers')
+    filing['fiscalYearEnd'] = etree_child_as_int(xbrlFiling,ns+'fiscalYearEnd')
+    filing['instanceUrl'] = None
+    filing['instanceUrls'] = []
+    filing['exhibitList'] = []
+    for xbrlFile in xbrlFiling.find(ns+'xbrlFiles'):
+        url = collapse_whitespace(xbrlFile.get(ns+'url'))
+        fileType = xbrlFile.get(ns+'type')
+        inlineXBRL = xbrlFile.get(ns+'inlineXBRL')
+        if inlineXBRL is not None and collapse_whitespace(inlineXBRL) in ('1','true'):
+            if filing['instanceUrl'] is None:
+                filing['instanceUrl'] = dir+'/'+filing['accessionNumber']+'-xbrl.zip%7Czip/'+url.split('/')[-1]
+            filing['instanceUrls'].append(dir+'/'+filing['accessionNumber']+'-xbrl.zip%7Czip/'+url.split('/')[-1])
+        elif fileType.endswith('.INS') and url.endswith('.xml'):
+            filing['instanceUrl'] = dir+'/'+filing['accessionNumber']+'-xbrl.zip%7Czip/'+url.split('/')[-1]
+        elif ex_re.match( fileType ):
+            filing['exhibitList'].append(url)
+    return filing
+
+def iter_feed(filepath):
+    """Yields a dict object with EDGAR meta information for each item/filing in the RSS feed.
+
+    In contrast to load_feed/parse_feed the feed is streamed without building a DOM of the whole document and without schema validation."""
+    dir = 'filings/'+re.fullmatch(r'.*xbrlrss-(\d{4}-\d{2})\.xml',os.path.basename(filepath)).group(1)
+
+    parent = None
+    for event, elem in ElementTree.iterparse(filepath,events=('start','end')):
+        if event == 'start':
+            if elem.tag == 'channel':
+                parent = elem
+        elif elem.tag == 'item':
+            yield parse_feed_item(elem,dir)
+            # Discard the already processed item to keep memory usage constant
+            if parent is not None:
+                parent.remove(elem)
+            elem.clear()
+
+def validate_feed(filepath):
+    """Validates the RSS feed against the EDGAR RSS schema and raises a RuntimeError if the feed is invalid."""
+    load_feed(filepath)
+
+def stream_feed(filepath,validate=False):
+    """Yields a dict object with EDGAR meta information for each filing in the RSS feed without holding all filings in memory.
+
+    The filings are taken from the cache if it is up-to-date, otherwise the feed is streamed (without writing the cache).
+    If validate is True, the feed is validated with RaptorXML first. Use read_feed if a list of all filings is needed."""
+    if validate:
+        validate_feed(filepath)
+    filings = read_cached_feed(filepath)
+    if filings is not None:
+        yield from filings
+    else:
+        logger.info('Streaming RSS feed %s',filepath)
+        yield from iter_feed(filepath)
+
+def read_feed(filepath,use_cache=True,validate=False):
+    """Return a list of dict objects with EDGAR meta information for each filing in the RSS feed.
+
+    By default the feed is streamed without schema validation. If validate is True, the feed is loaded and validated with RaptorXML first."""
+    start = time.perf_counter()
+    feed = load_feed(filepath) if validate else None
+    if use_cache:
+        filings = read_cached_feed(filepath)
+        if filings is not None:
+            logger.info('Loaded RSS feed %s from cache (%d filings in %.3fs)',filepath,len(filings),time.perf_counter()-start)
+            return filings
+
+    if feed:
+        filings = parse_feed(feed)
+    else:
+        logger.info('Streaming RSS feed %s',filepath)
+        filings = list(iter_feed(filepath))
+    logger.info('Parsed RSS feed %s (%d filings in %.3fs)',filepath,len(filings),time.perf_counter()-start)
+    if use_cache:
+        try:
+            write_cached_feed(filepath,filings)
+        except OSError:
+            logger.exception('Failed writing feed cache for %s',filepath)
+    return filings
+
+def read_feeds(filepaths,validate=False):
     """Return a list of dict objects with EDGAR meta information for each filing in the RSS feeds."""
     filings = []
     for filepath in filepaths:
-        filings.append(read_feed(filepath))
+        filings.append(read_feed(filepath,validate=validate))
     return filings
 
+def load_ticker_symbols():
+    """Returns a dict of CIK to ticker symbol."""
+    logger.info('Loading ticker file %s',tickers_file)
+
+    tickers = {}
+    with open(tickers_file,'r') as f:
+        reader = csv.reader(f)
+        for row in reader:
+            tickers[int(row[1])] = row[0].split('^')[0]
+    return tickers
+
+# Form types processed by build_secdb
+secdb_form_types = ('10-K','10-K/A','10-Q','10-Q/A')
+
+def secdb_cik(filing):
+    """Returns the CIK number under which the filing is stored in the SEC DB."""
+    # Google to Alphabet reorganization
+    if filing['cikNumber'] == 1288776:
+        return 1652044
+    return filing['cikNumber']
+
+def is_secdb_filing(filing,tickers,ciks=None):
+    """Returns True if the filing is processed by build_secdb, i.e. a 10-K/10-Q filing (or amendment) of a company with an assigned ticker symbol (and one of the given CIK numbers)."""
+    if filing.get('cikNumber') is None:
+        return False
+    cik = secdb_cik(filing)
+    return (ciks is None or cik in ciks) and filing['formType'] in secdb_form_types and cik in tickers
+
 def instance_url(filing):
     return urllib.parse.urljoin(root_url, filing['instanceUrl'])
 
@@ -265,6 +484,34 @@ def instance_urls(filing):
     else:
         return [urllib.parse.urljoin(root_url, filing['instanceUrl'])]
 
+def filing_archive_path(filing):
+    """Returns the local path of the zip archive containing the filing's XBRL instance or None if the filing has no instance."""
+    if not filing.get('instanceUrl'):
+        return None
+    return os.path.join(root_dir,*filing['instanceUrl'].split('%7Czip/')[0].split('/'))
+
+def verify_zip(filepath):
+    """Returns None if the zip archive is intact (readable central directory and matching CRCs of all members), otherwise a str describing the problem."""
+    try:
+        with zipfile.ZipFile(filepath) as archive:
+            member = archive.testzip()
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+    if member is not None:
+        return 'Bad CRC or file header of member %s' % member
+    return None
+
+def quarantine_file(filepath):
+    """Moves a corrupt file into the quarantine directory and returns its new path."""
+    os.makedirs(quarantine_dir,exist_ok=True)
+    name = os.path.basename(filepath)
+    if name.endswith('.part'):
+        name = name[:-len('.part')]
+    target = os.path.join(quarantine_dir,'%s.%s'%(name,datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')))
+    shutil.move(filepath,target)
+    logger.warning('Moved corrupt file %s to %s',filepath,target)
+    return target
+
 def load_instance(filing):
     urls = instance_urls(filing)
     logger.debug('Loading XBRL instance %s', ', '.join(urls))
@@ -0,0 +1,172 @@
+# Copyright 2015 Altova GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+__copyright__ = 'Copyright 2015 Altova GmbH'
+__license__ = 'http://www.apache.org/licenses/LICENSE-2.0'
+
+# This module maintains a persistent SQLite index of the items/filings in all EDGAR RSS feeds.
+# The index is updated incrementally: a feed is only re-read if its size or modification time changed.
+
+import feed_tools
+import os.path,sqlite3,json,datetime,logging
+
+# create logger
+logger = logging.getLogger('default')
+
+"""Returns the path to the SQLite file containing the filings index."""
+index_path = os.path.join(feed_tools.feed_dir,'index.db3')
+
+# Columns storing the EDGAR meta information of a filing (in addition to feed and pos)
+item_fields = ('accessionNumber','cikNumber','companyName','formType','filingDate','fileNumber','acceptanceDatetime','period','assistantDirector','assignedSic','otherCikNumbers','fiscalYearEnd','enclosureUrl','enclosureLength','instanceUrl','instanceUrls','exhibitList')
+
+def connect():
+    """Returns a connection to the filings index and creates the index tables if necessary."""
+    os.makedirs(os.path.dirname(index_path),exist_ok=True)
+    con = sqlite3.connect(index_path)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.executescript("""
+CREATE TABLE IF NOT EXISTS feeds (
+    feed TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    version INTEGER
+);
+CREATE TABLE IF NOT EXISTS items (
+    feed TEXT,
+    pos INTEGER,
+    accessionNumber CHAR(20),
+    cikNumber INTEGER,
+    companyName TEXT,
+    formType TEXT,
+    filingDate DATE,
+    fileNumber TEXT,
+    acceptanceDatetime DATETIME,
+    period DATE,
+    assistantDirector TEXT,
+    assignedSic INTEGER,
+    otherCikNumbers TEXT,
+    fiscalYearEnd INTEGER,
+    enclosureUrl TEXT,
+    enclosureLength INTEGER,
+    instanceUrl TEXT,
+    instanceUrls TEXT,
+    exhibitList TEXT,
+    PRIMARY KEY (feed,pos)
+);
+CREATE INDEX IF NOT EXISTS items_cik ON items (cikNumber);
+CREATE INDEX IF NOT EXISTS items_form_type ON items (formType);
+CREATE INDEX IF NOT EXISTS items_sic ON items (assignedSic);
+CREATE INDEX IF NOT EXISTS items_filing_date ON items (filingDate);
+CREATE INDEX IF NOT EXISTS items_period ON items (period);
+CREATE INDEX IF NOT EXISTS items_company ON items (companyName);
+CREATE INDEX IF NOT EXISTS items_accession ON items (accessionNumber);
+""")
+    return con
+
+def feed_name(feedpath):
+    """Returns the name under which the RSS feed is stored in the index (e.g. xbrlrss-2015-04.xml)."""
+    return os.path.basename(feedpath)
+
+def item_row(feed,pos,filing):
+    """Returns the index row for the given filing dict."""
+    row = [feed,pos]
+    for key in item_fields:
+        value = filing.get(key)
+        if key in ('instanceUrls','exhibitList'):
+            value = json.dumps(value) if value is not None else None
+        elif isinstance(value,(datetime.date,datetime.datetime)):
+            value = value.isoformat()
+        row.append(value)
+    return row
+
+def row_filing(row):
+    """Returns the filing dict for the given index row (as returned by parse_feed)."""
+    filing = {}
+    for key, value in zip(item_fields,row):
+        if key in ('enclosureUrl','enclosureLength'):
+            if row[item_fields.index('enclosureUrl')] is None:
+                continue
+        elif row[0] is None:
+            # Feed item without <edgar:xbrlFiling> element
+            continue
+        if value is not None:
+            if key in ('filingDate','period'):
+                value = datetime.date.fromisoformat(value)
+            elif key == 'acceptanceDatetime':
+                value = datetime.datetime.fromisoformat(value)
+            elif key in ('instanceUrls','exhibitList'):
+                value = json.loads(value)
+        filing[key] = value
+    return filing
+
+def update_feed(con,feedpath,validate=False):
+    """Re-reads the RSS feed into the index if it is new or has changed since it was last indexed. Returns True if the feed was re-indexed."""
+    feed = feed_name(feedpath)
+    stat = os.stat(feedpath)
+    state = (stat.st_size,stat.st_mtime_ns,feed_tools.feed_cache_version)
+    row = con.execute('SELECT size, mtime, version FROM feeds WHERE feed = ?',(feed,)).fetchone()
+    if row == state:
+        return False
+
+    logger.info('Indexing RSS feed %s',feedpath)
+    filings = feed_tools.stream_feed(feedpath,validate=validate)
+    with con:
+        con.execute('DELETE FROM items WHERE feed = ?',(feed,))
+        con.executemany('INSERT INTO items VALUES(%s)' % ','.join(['?']*(len(item_fields)+2)),(item_row(feed,pos,filing) for pos, filing in enumerate(filings)))
+        con.execute('INSERT OR REPLACE INTO feeds VALUES(?,?,?,?)',(feed,)+state)
+    return True
+
+def update_index(feedpaths,validate=False):
+    """Brings the index up-to-date for all given RSS feeds."""
+    con = connect()
+    try:
+        for feedpath in feedpaths:
+            update_feed(con,feedpath,validate)
+    finally:
+        con.close()
+
+def select_filings(feedpaths=None,cik=None,sic=None,form_types=None,company_re=None,acc=None,update=True,validate=False):
+    """Returns a list of filing dicts from the index matching all of the given criteria.
+
+    feedpaths restricts the search to the given RSS feeds which (unless update is False) are re-indexed first if necessary.
+    cik can be a single CIK number or a list of CIK numbers, form_types a single form type or a list of form types."""
+    con = connect()
+    try:
+        conditions, params = [], []
+        if feedpaths is not None:
+            feedpaths = list(feedpaths)
+            if update:
+                for feedpath in feedpaths:
+                    update_feed(con,feedpath,validate)
+            conditions.append('feed IN (%s)' % ','.join(['?']*len(feedpaths)))
+            params.extend(feed_name(feedpath) for feedpath in feedpaths)
+        for column, value in (('cikNumber',cik),('assignedSic',sic),('formType',form_types),('accessionNumber',acc)):
+            if value is None:
+                continue
+            if isinstance(value,(list,tuple,set)):
+                conditions.append('%s IN (%s)' % (column,','.join(['?']*len(value))))
+                params.extend(value)
+            else:
+                conditions.append('%s = ?' % column)
+                params.append(value)
+        if company_re:
+            con.create_function('company_match',1,lambda name: name is not None and bool(company_re.match(name)),deterministic=True)
+            conditions.append('company_match(companyName)')
+
+        query = 'SELECT %s FROM items' % ','.join(item_fields)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY feed, pos'
+        return [row_filing(row) for row in con.execute(query,params)]
+    finally:
+        con.close()
@@ -28,8 +28,8 @@ def collect_feeds(args):
 		for feedpath in glob.iglob(os.path.abspath(arg)):
 			yield feedpath
 	
-def generate_project(feedpath):
-	filings = feed_tools.read_feed(feedpath)
+def generate_project(feedpath,validate_feed=False):
+	filings = feed_tools.read_feed(feedpath,validate=validate_feed)
 	filings_by_company = {}
 	for filing in filings:
 		filings_by_company.setdefault(filing['companyName'],[]).append(filing)
@@ -83,6 +83,7 @@ def parse_args():
 	"""Returns the arguments and options passed to the script."""
 	parser = argparse.ArgumentParser(description='Generates XMLSpy .spp project file from EDGAR RSS feed for a given month.')
 	parser.add_argument('rss_feeds', metavar='RSS', nargs='+', help='EDGAR RSS feed file')
+	parser.add_argument('--validate-feeds', action='store_true', help='validate the EDGAR RSS feeds against the RSS schema before reading them')
 	return parser.parse_args()	
 
 def main():
@@ -90,7 +91,7 @@ def main():
 	args = parse_args()	
 	
 	for feedpath in collect_feeds(args.rss_feeds):
-		generate_project(feedpath)
+		generate_project(feedpath,args.validate_feeds)
 
 if __name__ == '__main__':
 	start = time.perf_counter()
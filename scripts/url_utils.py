@@ -1,4 +1,6 @@
 import urllib.request
 
+user_agent = "Altova/1.0"
+
 def mk_req( url ):
-    return urllib.request.Request( url, headers={"User-Agent": "Altova/1.0"} )
+    return urllib.request.Request( url, headers={"User-Agent": user_agent} )
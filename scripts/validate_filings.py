@@ -68,6 +68,7 @@ def parse_args():
     parser.add_argument('--form-type', help='Form type (10-K,10-Q,...)')
     parser.add_argument('--company', help='Company name')
     parser.add_argument('--threads', type=int, default=multiprocessing.cpu_count(), dest='max_threads', help='specify max number of threads')
+    parser.add_argument('--validate-feeds', action='store_true', help='validate the EDGAR RSS feeds against the RSS schema before reading them')
     args = parser.parse_args()
     args.company_re = re.compile(args.company, re.I) if args.company else None
     if args.cik:
@@ -103,7 +104,7 @@ def main():
 
         # Load EDGAR filing metadata from RSS feed (and filter out all non 10-K/10-Q filings or companies without an assigned ticker symbol)
         filings = []
-        for filing in feed_tools.read_feed(filepath):
+        for filing in feed_tools.stream_feed(filepath,validate=args.validate_feeds):
             # Google to Alphabet reorganization
             if filing['cikNumber'] == 1288776:
                 filing['cikNumber'] = 1652044